@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks LightweightUploader against ResumableUploadServer, a local stand-in for nginx
+with the upload module, over a real socket. For each mix of file sizes and each chunk size
+it reports files/s, MB/s and the p50/p99 time from queueing an upload to its final response.
+
+    python bench_py_lightweight_uploader.py --latency 0.005 --loss 0.01 --out-of-order 0.1 > bench_output.txt
+
+With --memory N it instead queues N uploads of files on disk without starting the uploader and
+reports how much the process grew per queued upload.
+
+The server can add latency to every reply, drop a request without replying (loss), and leave
+the segment just received out of a reply's Range header (out of order), reporting it only
+with the next reply, as nginx does when segments of one session land out of order.
+Uploads to its moved_url get a 301 to its url, with --moved to see what a relocated endpoint costs.
+"""
+
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+import gc
+from os import sysconf
+from optparse import OptionParser
+from random import Random
+import re
+from SocketServer import ThreadingMixIn
+from threading import Thread, Lock
+from time import sleep, time
+
+from py_lightweight_uploader import (LightweightUploader, RetryPolicy, merge_ranges,
+                                     format_received_ranges, __vcs_id__)
+
+CONTENT_RANGE_PATTERN = re.compile(r'bytes (?P<first>\d+)-(?P<last>\d+)/(?P<total>\d+)')
+
+# name -> [(file size in bytes, how many of them), ...]
+FILE_SIZE_MIXES = {
+    'small': [(4 * 1024, 200)],
+    'mixed': [(1024, 100), (64 * 1024, 50), (1024 * 1024, 10), (8 * 1024 * 1024, 2)],
+    'large': [(32 * 1024 * 1024, 4)],
+}
+
+
+class ResumableUploadHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'       # keep-alive, so the uploader's connection pool gets used
+    wbufsize = -1                       # write each reply in one go, flushed by handle_one_request,
+    disable_nagle_algorithm = True      # and right away, or we'd be measuring delayed ACKs
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, headers=()):
+        self.send_response(status)
+        for header in headers:
+            self.send_header(*header)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_POST(self):
+        server = self.server
+        body_length = int(self.headers.getheader('Content-Length', 0))
+        while body_length > 0:
+            body_length -= len(self.rfile.read(min(body_length, 64 * 1024)))
+        if server.latency:
+            sleep(server.latency)
+        if server.chance(server.loss):
+            self.close_connection = 1       # lost: the client never hears back
+            return
+        if self.path.startswith('/moved'):
+            server.redirected += 1
+            self.reply(301, [('Location', '/upload' + self.path[len('/moved'):])])
+            return
+
+        session_id = self.headers.getheader('Session-ID')
+        content_range = CONTENT_RANGE_PATTERN.match(self.headers.getheader('X-Content-Range') or '')
+        if session_id is None or content_range is None:
+            self.reply(200)                 # a simple upload, all in one request
+            return
+        first, last, total = [int(n) for n in content_range.groups()]
+        received, reported = server.receive(session_id, (first, last), total)
+        if received is None:
+            self.reply(200)
+        else:
+            self.reply(201, [('Range', '%s/%d' % (format_received_ranges(reported), total))])
+
+
+class ResumableUploadServer(ThreadingMixIn, HTTPServer):
+    """
+    The server side of the resumable upload protocol, as the nginx upload module speaks it:
+    a chunk comes with X-Content-Range and Session-ID, and gets a 201 with a Range header of every
+    segment received so far until the whole file is there, which gets a 200. No bytes are kept.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), latency=0, loss=0, out_of_order=0, seed=None):
+        HTTPServer.__init__(self, address, ResumableUploadHandler)
+        self.latency = latency
+        self.loss = loss
+        self.out_of_order = out_of_order
+        self.random = Random(seed)
+        self.lock = Lock()
+        self.sessions = {}      # Session-ID -> [(first, last), ...] received so far
+        self.completed = 0      # sessions that got all their bytes. A late resend of a segment starts a new one.
+        self.redirected = 0     # requests to moved_url
+
+    @property
+    def url(self):
+        return 'http://%s:%d/upload' % self.server_address
+
+    @property
+    def moved_url(self):
+        return 'http://%s:%d/moved' % self.server_address
+
+    def chance(self, probability):
+        self.lock.acquire(True)
+        try:
+            return self.random.random() < probability
+        finally:
+            self.lock.release()
+
+    def receive(self, session_id, segment, total):
+        """
+        Add segment to the session. Returns (None, None) once the session has all total bytes,
+        otherwise every segment received and those to report, which may leave out this one.
+        """
+        self.lock.acquire(True)
+        try:
+            before = self.sessions.get(session_id, [])
+            received = merge_ranges(sorted(before + [segment]))
+            if received == [(0, total - 1)]:
+                self.sessions.pop(session_id, None)
+                self.completed += 1
+                return None, None
+            self.sessions[session_id] = received
+            if before and self.random.random() < self.out_of_order:
+                return received, before
+            return received, received
+        finally:
+            self.lock.release()
+
+    def start(self):
+        thread = Thread(target=self.serve_forever, name='ResumableUploadServer')
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+def run_benchmark(url, sizes, chunk_size, worker_count=4, parallel_chunks=1, retry_policy=None):
+    """
+    Upload a file of each size in sizes to url and wait for them all.
+    Returns (seconds, total bytes, sorted upload latencies in seconds, how many failed).
+    """
+    retry_policy = retry_policy if retry_policy is not None else RetryPolicy(max_retries=10, base_delay=0.01, max_delay=1.0)
+    uploader = LightweightUploader(name='bench', worker_count=worker_count, retry_policy=retry_policy)
+    contents = dict((size, 'x' * size) for size in set(sizes))
+    latencies = []
+    failures = []
+    started = time()
+    uploader.start()
+    for i, size in enumerate(sizes):
+        queued = time()
+        def done(future, queued=queued):
+            latencies.append(time() - queued)
+            try:
+                response = future.result()
+            except Exception:
+                response = None
+            if response is None or response.status != 200:
+                failures.append(future.id)
+        future = uploader.submit_upload('bench_%d.bin' % i, url, content=contents[size],
+                                        chunk_size=chunk_size, parallel_chunks=parallel_chunks)
+        future.add_done_callback(done)
+    uploader.wait_all()
+    elapsed = time() - started
+    uploader.connection_pool.close_idle()
+    return elapsed, sum(sizes), sorted(latencies), len(failures)
+
+def resident_bytes():
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * sysconf('SC_PAGE_SIZE')
+
+def queued_bytes_per_upload(how_many, url='http://127.0.0.1:8080/upload'):
+    """
+    How much resident memory grows per upload queued with enqueue_upload, on Linux.
+    The uploader isn't started, so the uploads just sit in the queue. File names are included.
+    """
+    uploader = LightweightUploader(name='bench')
+    gc.collect()
+    before = resident_bytes()
+    for i in xrange(how_many):
+        uploader.enqueue_upload('/var/spool/receipts/receipt_%08d.json' % i, url, additional_data={'batch': '42'})
+    gc.collect()
+    return (resident_bytes() - before) / float(how_many)
+
+def file_sizes(mix, scale=1.0):
+    sizes = []
+    for size, how_many in FILE_SIZE_MIXES[mix]:
+        sizes += [size] * max(1, int(how_many * scale))
+    return sizes
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='usage: %prog [options]', version=__vcs_id__)
+    parser.add_option('-m', '--mixes', dest='mixes', default='small,mixed,large',
+                      help='file size mixes to run, of %s' % ', '.join(sorted(FILE_SIZE_MIXES)))
+    parser.add_option('-c', '--chunk-sizes', dest='chunk_sizes', default='51200,262144,1048576',
+                      help='chunk sizes in bytes to run each mix with')
+    parser.add_option('-s', '--scale', dest='scale', type='float', default=1.0,
+                      help='multiply the number of files in each mix by this')
+    parser.add_option('-w', '--workers', dest='workers', type='int', default=4)
+    parser.add_option('-p', '--parallel-chunks', dest='parallel_chunks', type='int', default=1)
+    parser.add_option('-l', '--latency', dest='latency', type='float', default=0,
+                      help='seconds the server waits before each reply')
+    parser.add_option('--loss', dest='loss', type='float', default=0,
+                      help='fraction of requests the server drops without replying')
+    parser.add_option('--out-of-order', dest='out_of_order', type='float', default=0,
+                      help='fraction of replies that leave out the segment just received')
+    parser.add_option('--seed', dest='seed', type='int', default=None)
+    parser.add_option('--moved', dest='moved', action='store_true', default=False,
+                      help='upload to a URL the server permanently redirects')
+    parser.add_option('--memory', dest='memory', type='int', default=None, metavar='N',
+                      help='just report bytes of memory per queued upload, queueing N of them')
+    (options, arguments) = parser.parse_args()
+
+    if options.memory is not None:
+        print '%d queued uploads: %.0f bytes each' % (options.memory, queued_bytes_per_upload(options.memory))
+        raise SystemExit()
+
+    server = ResumableUploadServer(latency=options.latency, loss=options.loss,
+                                   out_of_order=options.out_of_order, seed=options.seed).start()
+    print '%-6s %10s %6s %10s %9s %9s %9s %6s' % (
+        'mix', 'chunk', 'files', 'files/s', 'MB/s', 'p50 s', 'p99 s', 'failed')
+    for mix in options.mixes.split(','):
+        sizes = file_sizes(mix, options.scale)
+        for chunk_size in [int(c) for c in options.chunk_sizes.split(',')]:
+            elapsed, total_bytes, latencies, failed = run_benchmark(
+                server.moved_url if options.moved else server.url, sizes, chunk_size,
+                options.workers, options.parallel_chunks)
+            print '%-6s %10d %6d %10.1f %9.2f %9.4f %9.4f %6d' % (
+                mix, chunk_size, len(sizes), len(sizes) / elapsed, total_bytes / elapsed / 1024 / 1024,
+                percentile(latencies, 0.5), percentile(latencies, 0.99), failed)
+    server.shutdown()
@@ -1,17 +1,29 @@
 #!/usr/bin/env python
 
+from bisect import bisect_left
+from collections import deque, OrderedDict
 from cStringIO import StringIO
-from httplib import HTTPConnection, HTTPSConnection
+from glob import iglob
+import hashlib
+from heapq import heapify, heappush, heappop
+from httplib import HTTPConnection, HTTPSConnection, HTTPException
+from itertools import count, islice
 from logging import debug, info, warning, critical
 from mimetypes import guess_type
-from os import SEEK_END
-from random import randint
+from os import SEEK_END, stat
+from os.path import isfile, join
+from random import randint, random
 import re
-from threading import Thread, Lock
-from time import sleep
+import socket
+import sqlite3
+import sys
+from tempfile import SpooledTemporaryFile
+from threading import Thread, Lock, Condition, Event
+from time import sleep, time
 from urllib import quote_plus, urlencode
-from urlparse import urlparse, ParseResult, urlunparse
-from uuid import uuid4
+from urlparse import urlparse, ParseResult, urlunparse, urljoin
+from uuid import uuid4, UUID
+import zlib
 
 __author__ = 'Andrew Hammond <andrew.hammond@receipt.com>'
 __copyright__ = 'Copyright (c) 2011 SmartReceipt'
@@ -43,12 +55,41 @@ or implied, of SmartReceipt Inc.
 __vcs_id__ = '$Id$'
 
 
-# Note: this pattern recognizes the first contiguous segment of the file.
-# There may be other segments already uploaded.
-# In that case, we ignore the subsequent segments and simply find the first
-# MISSING segment. This doesn't necessarily mean we will re-upload anything,
-# since, after uploading the first missing segment, we check again.
-RECEIVED_RANGE_PATTERN = re.compile(r'^0-(?P<next_byte_to_upload>\d+)')
+# Matches every first-last segment in a Range header like '0-99,200-299/4096'.
+# The server may already have segments past the first hole (nginx accepts them out of order),
+# so we keep all of them in UploadableFile.received_ranges and only ever send the holes.
+RECEIVED_SEGMENT_PATTERN = re.compile(r'(?P<first>\d+)-(?P<last>\d+)')
+
+def parse_received_ranges(received_range):
+    """
+    Turn a Range header such as '0-99,200-299/4096' into a sorted list of merged,
+    inclusive (first, last) tuples. Returns an empty list for an empty or odd header.
+    """
+    if not received_range:
+        return []
+    segments = received_range.split('/', 1)[0]
+    ranges = sorted((int(m.group('first')), int(m.group('last')))
+                    for m in RECEIVED_SEGMENT_PATTERN.finditer(segments))
+    return merge_ranges(ranges)
+
+def format_received_ranges(ranges):
+    """
+    The inverse of parse_received_ranges, without the '/total' part: [(0, 99), (200, 299)] -> '0-99,200-299'
+    """
+    return ','.join('%d-%d' % r for r in ranges)
+
+def merge_ranges(ranges):
+    """
+    Merge a sorted list of inclusive (first, last) tuples, joining overlapping and adjacent ones.
+    """
+    merged = []
+    for first, last in ranges:
+        if merged and first <= merged[-1][1] + 1:
+            if last > merged[-1][1]:
+                merged[-1] = (merged[-1][0], last)
+        else:
+            merged.append((first, last))
+    return merged
 
 def fold_additional_data(url, additional_data):
     if not additional_data:
@@ -64,11 +105,817 @@ def fold_additional_data(url, additional_data):
             fragment=url.fragment
         )
 
+class NoDelayHTTPConnection(HTTPConnection):
+    """
+    An HTTPConnection with Nagle's algorithm turned off. httplib writes the headers and a file-like
+    body separately, and with Nagle on the body waits for the server to ACK the headers, which
+    it delays by up to 40ms. That is most of the time a small chunk takes on a fast link.
+    """
+
+    def connect(self):
+        HTTPConnection.connect(self)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+class NoDelayHTTPSConnection(HTTPSConnection):
+    """
+    The same for HTTPS.
+    """
+
+    def connect(self):
+        HTTPSConnection.connect(self)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+def new_connection(url):
+    """
+    A fresh NoDelayHTTPConnection or NoDelayHTTPSConnection for the scheme and netloc of url, a ParseResult.
+    """
+    scheme = url.scheme.lower()
+    if 'http' == scheme:
+        return NoDelayHTTPConnection(url.netloc)
+    elif 'https' == scheme:
+        return NoDelayHTTPSConnection(url.netloc)
+    raise ValueError("I only know how to upload via either http https, not %r" % url.scheme)
+
+
+class ConnectionPool(object):
+    """
+    Keep-alive connections shared by all uploads, keyed by scheme and host.
+
+    At most max_per_host connections to one host are handed out at a time; acquire() waits
+    for one to come back (or returns None if told not to block). Connections idle for longer
+    than idle_timeout seconds are closed rather than reused, since the server has probably
+    dropped them already. A connection that broke anyway is reopened by UploadableFile.
+    """
+
+    def __init__(self, max_per_host=8, idle_timeout=60.0):
+        if max_per_host < 1:
+            raise ValueError('max_per_host must be at least 1, got %r' % max_per_host)
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.lock = Condition()
+        self.idle = {}      # (scheme, netloc) -> [(connection, released_at), ...], most recent last
+        self.in_use = {}    # (scheme, netloc) -> number of connections handed out
+
+    @staticmethod
+    def key(url):
+        return url.scheme.lower(), url.netloc.lower()
+
+    def acquire(self, url, block=True):
+        key = self.key(url)
+        self.lock.acquire(True)
+        try:
+            self.evict_idle()
+            while self.in_use.get(key, 0) >= self.max_per_host:
+                if not block:
+                    return None
+                self.lock.wait()
+                self.evict_idle()
+            self.in_use[key] = self.in_use.get(key, 0) + 1
+            idle = self.idle.get(key)
+            if idle:
+                return idle.pop()[0]
+        finally:
+            self.lock.release()
+        debug('Opening a new connection to %s://%s', *key)
+        try:
+            return new_connection(url)
+        except Exception:
+            self.lock.acquire(True)
+            try:
+                self.in_use[key] -= 1       # the slot we took, or waiters on this host would wait forever
+                self.lock.notify()
+            finally:
+                self.lock.release()
+            raise
+
+    def release(self, url, connection, reusable=True):
+        key = self.key(url)
+        self.lock.acquire(True)
+        try:
+            self.in_use[key] -= 1
+            if reusable:
+                self.idle.setdefault(key, []).append((connection, time()))
+            else:
+                connection.close()
+            self.lock.notify()
+        finally:
+            self.lock.release()
+
+    def evict_idle(self, max_idle=None):
+        """
+        Close connections idle for longer than max_idle seconds, idle_timeout by default.
+        Caller must hold self.lock.
+        """
+        oldest = time() - (self.idle_timeout if max_idle is None else max_idle)
+        for key, idle in self.idle.items():
+            while idle and idle[0][1] <= oldest:
+                idle.pop(0)[0].close()
+            if not idle:
+                del self.idle[key]
+
+    def close_idle(self):
+        """
+        Close every connection that isn't in use right now.
+        """
+        self.lock.acquire(True)
+        try:
+            self.evict_idle(max_idle=-1)
+        finally:
+            self.lock.release()
+
+
+class DestinationGroup(object):
+    """
+    Several upload URLs, one per host, that uploads are spread across. Give one to enqueue_upload
+    in place of an upload_url. Each upload is given a host when it is queued, by strategy:
+
+    'least_outstanding': the host with the fewest bytes of uploads given to it and not yet finished.
+    'consistent_hash': the host the upload_id hashes to on a ring of replicas points per host, so the
+      same id always goes to the same host, and adding or dropping a host only moves about 1/n of them.
+
+    Health is checked passively, by the uploads themselves: a host that fails max_failures requests
+    in a row (no connection, or a 5xx) is down for down_for seconds, and gets no new uploads. After that
+    it is tried again; one more failure puts it straight back down, one success makes it healthy.
+    If every host is down, uploads are spread across all of them regardless.
+
+    An upload sticks to its host, since the server keeps a session's bytes on the host that got them.
+    Only when that host goes down does the upload fail over to another, and if the old host had
+    confirmed any of it the upload starts over there under a new session. See UploadableFile.fail_over.
+    """
+
+    strategies = ('least_outstanding', 'consistent_hash')
+
+    def __init__(self, urls, strategy='least_outstanding', max_failures=3, down_for=30.0, replicas=64):
+        if not urls:
+            raise ValueError('A DestinationGroup needs at least one URL')
+        if strategy not in self.strategies:
+            raise ValueError('strategy must be one of %s, got %r' % (', '.join(self.strategies), strategy))
+        self.urls = [url if isinstance(url, ParseResult) else urlparse(url) for url in urls]
+        self.strategy = strategy
+        self.max_failures = max_failures
+        self.down_for = down_for
+        self.lock = Lock()
+        self.outstanding = [0] * len(self.urls)     # bytes of unfinished uploads given to each host
+        self.failures = [0] * len(self.urls)        # failed requests in a row
+        self.down_until = [0] * len(self.urls)
+        self.assigned = {}                          # UploadableFile -> (host index, bytes)
+        self.ring = sorted((self.hash('%s#%d' % (urlunparse(url), replica)), i)
+                           for i, url in enumerate(self.urls) for replica in range(replicas))
+
+    def __repr__(self):
+        return 'DestinationGroup([%s])' % ', '.join(repr(urlunparse(url)) for url in self.urls)
+
+    @staticmethod
+    def hash(key):
+        return int(hashlib.md5(str(key)).hexdigest()[:16], 16)
+
+    def is_down(self, host, now=None):
+        return self.failures[host] >= self.max_failures and (now if now is not None else time()) < self.down_until[host]
+
+    def choose(self, key, exclude=None):
+        """
+        Index of the host for the upload with key, never exclude unless it's the only host.
+        Caller must hold self.lock.
+        """
+        now = time()
+        hosts = [i for i in range(len(self.urls)) if i != exclude] or [exclude]
+        candidates = [i for i in hosts if not self.is_down(i, now)] or hosts
+        if 'consistent_hash' == self.strategy:
+            start = bisect_left(self.ring, (self.hash(key), -1))
+            for point, i in self.ring[start:] + self.ring[:start]:
+                if i in candidates:
+                    return i
+        return min(candidates, key=lambda i: self.outstanding[i])
+
+    def assign(self, file, key, size, exclude=None):
+        """
+        Give file, an upload of size bytes, a host and count its bytes as outstanding there.
+        Returns the host's index.
+        """
+        self.lock.acquire(True)
+        try:
+            previous = self.assigned.pop(file, None)
+            if previous is not None:
+                self.outstanding[previous[0]] -= previous[1]
+            host = self.choose(key, exclude)
+            self.outstanding[host] += size
+            self.assigned[file] = (host, size)
+            return host
+        finally:
+            self.lock.release()
+
+    def release(self, file):
+        """The upload of file is over, one way or another."""
+        self.lock.acquire(True)
+        try:
+            assigned = self.assigned.pop(file, None)
+            if assigned is not None:
+                self.outstanding[assigned[0]] -= assigned[1]
+        finally:
+            self.lock.release()
+
+    def succeeded(self, host):
+        self.failures[host] = 0
+
+    def failed(self, host):
+        self.lock.acquire(True)
+        try:
+            self.failures[host] += 1
+            if self.failures[host] >= self.max_failures:
+                if self.failures[host] == self.max_failures or not self.is_down(host):
+                    warning('%s is down, not sending it new uploads for %.0fs.', self.urls[host].netloc, self.down_for)
+                self.down_until[host] = time() + self.down_for
+        finally:
+            self.lock.release()
+
+
+class FileHandleCache(object):
+    """
+    A budget of at most max_open files open at once for all the uploads of a LightweightUploader.
+
+    An upload opens its file with open() just before sending a chunk and hands it back with
+    release() afterwards. Handed back files stay open, least recently used first, so the next chunk
+    doesn't have to reopen them, until room is needed for another file and the oldest is closed.
+    A file that is done with for good is closed by discard(). When every file in the budget is
+    in the middle of a chunk, open() waits for one to be released.
+
+    open() takes an opener for anything else that holds a file descriptor, such as the temporary
+    file a compressed upload is spooled to. The slot is taken first and the opener called without
+    the lock, so a slow one only holds up the file it is opening.
+    """
+
+    def __init__(self, max_open=256):
+        if max_open < 1:
+            raise ValueError('max_open must be at least 1, got %r' % max_open)
+        self.max_open = max_open
+        self.lock = Condition()
+        self.idle = OrderedDict()   # UploadableFile -> open file, least recently used first
+        self.in_use = {}            # UploadableFile -> open file
+
+    def open(self, file, opener=None):
+        self.lock.acquire(True)
+        try:
+            handle = self.idle.pop(file, None)
+            if handle is not None:
+                self.in_use[file] = handle
+                return handle
+            while len(self.idle) + len(self.in_use) >= self.max_open:
+                if self.idle:
+                    self.idle.popitem(last=False)[1].close()
+                else:
+                    self.lock.wait()
+            self.in_use[file] = None    # the slot is ours while we open it
+        finally:
+            self.lock.release()
+        try:
+            handle = opener(file) if opener is not None else open(file.file_name, 'rb')
+        except Exception:
+            self.discard(file)
+            raise
+        self.lock.acquire(True)
+        try:
+            self.in_use[file] = handle
+            return handle
+        finally:
+            self.lock.release()
+
+    def release(self, file):
+        self.lock.acquire(True)
+        try:
+            handle = self.in_use.pop(file, None)
+            if handle is not None:
+                self.idle[file] = handle
+                self.lock.notify()
+        finally:
+            self.lock.release()
+
+    def discard(self, file):
+        self.lock.acquire(True)
+        try:
+            if file in self.in_use or file in self.idle:
+                handle = self.in_use.pop(file, None) or self.idle.pop(file, None)
+                if handle is not None:
+                    handle.close()
+                self.lock.notify()
+        finally:
+            self.lock.release()
+
+    def __len__(self):
+        return len(self.idle) + len(self.in_use)
+
+
+class UploadJournal(object):
+    """
+    An SQLite file remembering every queued upload of a file on disk: its upload_id, file name,
+    destination, Session-ID and the byte ranges the server has confirmed. Entries go away when
+    the upload finishes, fails or is canceled, so whatever is left after a crash is unfinished work.
+
+    The resumable protocol has no way to ask the server what it has short of sending a chunk,
+    so an upload replayed from the journal starts at the first hole in its confirmed ranges
+    and the server's reply to that first chunk sets it straight if it knows more.
+
+    Uploads of in-memory content aren't journaled: after a restart there is nothing to re-read.
+    Nor are compressed ones, whose ranges are of bytes that only exist in a temporary file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS uploads ('
+            ' id TEXT PRIMARY KEY,'
+            ' file_name TEXT NOT NULL,'
+            ' destination_url TEXT NOT NULL,'
+            ' destination_filename TEXT,'
+            ' session_id INTEGER NOT NULL,'
+            ' received_ranges TEXT NOT NULL,'
+            ' queued_at REAL NOT NULL)')
+        self.connection.commit()
+
+    def execute(self, sql, parameters=()):
+        self.lock.acquire(True)
+        try:
+            rows = self.connection.execute(sql, parameters).fetchall()
+            self.connection.commit()
+            return rows
+        finally:
+            self.lock.release()
+
+    @staticmethod
+    def is_journaled(file):
+        return file.content is None and file.compression is None
+
+    def record(self, id, file):
+        self.record_many([(id, file)])
+
+    def record_many(self, uploads):
+        """
+        Record (upload_id, UploadableFile) pairs in one transaction.
+        """
+        now = time()
+        rows = [(str(id), file.file_name, urlunparse(file.destination_url), file._destination_filename,
+                 file.session_id, format_received_ranges(file.received_ranges), now)
+                for id, file in uploads if self.is_journaled(file)]
+        if not rows:
+            return
+        self.lock.acquire(True)
+        try:
+            self.connection.executemany('INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            self.connection.commit()
+        finally:
+            self.lock.release()
+
+    def update(self, id, file):
+        """
+        Record the ranges confirmed so far, and the destination and session, which change on fail over.
+        """
+        if self.is_journaled(file):
+            self.execute('UPDATE uploads SET destination_url = ?, session_id = ?, received_ranges = ? WHERE id = ?',
+                         (urlunparse(file.destination_url), file.session_id,
+                          format_received_ranges(file.received_ranges), str(id)))
+
+    def remove(self, id):
+        self.execute('DELETE FROM uploads WHERE id = ?', (str(id),))
+
+    def entries(self):
+        """
+        (upload_id, file_name, destination_url, destination_filename, session_id, received_ranges)
+        for every unfinished upload, oldest first.
+        """
+        for row in self.execute('SELECT id, file_name, destination_url, destination_filename, session_id,'
+                                ' received_ranges FROM uploads ORDER BY queued_at'):
+            yield (UUID(row[0]), row[1], row[2], row[3], row[4], parse_received_ranges(row[5]))
+
+
+class UploadCache(object):
+    """
+    Remembers what has been uploaded where, by a digest of the content, so LightweightUploader
+    can skip uploading the same bytes to the same place twice.
+
+    The key is (hex digest, destination, destination filename), where the destination is the URL,
+    or for a DestinationGroup the group and additional_data. completed maps keys to the
+    final response of uploads that got a 200, least recently used first; there are at most
+    max_entries of them, and each is forgotten ttl seconds after it was uploaded. in_flight maps
+    the key of every upload queued or in progress to (upload_id, duplicates), the (file, future)
+    pairs queued since that are waiting on it instead of being uploaded again.
+
+    Files are hashed block by block, so a big file is never in memory at once. That happens on
+    the thread queueing the upload. Apart from key(), everything here is guarded by the uploader's lock.
+    """
+
+    def __init__(self, max_entries=1024, ttl=24 * 60 * 60, hash_name='sha1', block_size=64 * 1024):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hash_name = hash_name
+        self.block_size = block_size
+        self.completed = OrderedDict()      # key -> (response, uploaded_at)
+        self.in_flight = {}                 # key -> (upload_id, [(file, future), ...])
+
+    def key(self, file):
+        digest = hashlib.new(self.hash_name)
+        if isinstance(file.content, str):
+            digest.update(file.content)
+        else:
+            # not file.file_handle, which would hold a file open from now until its upload starts,
+            # but the same fallbacks: a handle of our own, the content as a file, or as a string
+            handle = file.open_content()
+            try:
+                for block in iter(lambda: handle.read(self.block_size), ''):
+                    digest.update(block)
+            finally:
+                if file.content is None:
+                    handle.close()
+        if file.destination_group is not None:
+            # The group, not the host the upload is given, which differs between duplicates.
+            destination = (file.destination_group, urlencode(file.additional_data) if file.additional_data else '')
+        else:
+            destination = urlunparse(file.destination_url)
+        return digest.hexdigest(), destination, file.destination_filename
+
+    def get(self, key):
+        """The response the upload with this key got, or None if there's none or it's too old."""
+        cached = self.completed.pop(key, None)
+        if cached is None:
+            return None
+        if cached[1] + self.ttl <= time():
+            return None
+        self.completed[key] = cached        # most recently used
+        return cached[0]
+
+    def put(self, key, response):
+        self.completed.pop(key, None)
+        self.completed[key] = (response, time())
+        while len(self.completed) > self.max_entries:
+            self.completed.popitem(last=False)
+
+
+class RedirectCache(object):
+    """
+    Where uploads to a destination were permanently redirected (301 or 308), so later uploads there
+    go straight to the new place rather than each being redirected on its first request.
+
+    Keyed by scheme, host and path: a cached redirect moves every upload to that endpoint, whatever
+    its query string, which it keeps. Redirects are forgotten ttl seconds after they were seen, and
+    there are at most max_entries of them, least recently seen first out. Thread-safe.
+    """
+
+    def __init__(self, ttl=60 * 60, max_entries=1024, max_hops=5):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_hops = max_hops
+        self.lock = Lock()
+        self.targets = OrderedDict()        # (scheme, netloc, path) -> (target ParseResult, seen_at)
+
+    @staticmethod
+    def key(url):
+        return url.scheme.lower(), url.netloc.lower(), url.path
+
+    def put(self, url, target):
+        key = self.key(url)
+        self.lock.acquire(True)
+        try:
+            self.targets.pop(key, None)
+            self.targets[key] = (target, time())
+            while len(self.targets) > self.max_entries:
+                self.targets.popitem(last=False)
+        finally:
+            self.lock.release()
+
+    def resolve(self, url):
+        """
+        url moved to wherever it was redirected, following up to max_hops cached redirects,
+        or url itself if it wasn't.
+        """
+        if not self.targets:
+            return url
+        now = time()
+        self.lock.acquire(True)
+        try:
+            for hop in range(self.max_hops):
+                key = self.key(url)
+                cached = self.targets.get(key)
+                if cached is None:
+                    break
+                if cached[1] + self.ttl <= now:
+                    del self.targets[key]
+                    break
+                target = cached[0]
+                url = ParseResult(scheme=target.scheme, netloc=target.netloc, path=target.path,
+                                  params=url.params, query=url.query, fragment=url.fragment)
+        finally:
+            self.lock.release()
+        return url
+
+
+class UploadCancelledError(Exception):
+    pass
+
+class UploadTimeoutError(Exception):
+    pass
+
+class UploadFuture(object):
+    """
+    The final response of an upload queued with LightweightUploader.submit_upload.
+    Modelled on concurrent.futures.Future: result() blocks until the upload finishes or is
+    canceled, and callbacks added with add_done_callback are called with the future once it has.
+    The response is the same one on_complete gets, so a failed upload resolves to its error response.
+    """
+
+    def __init__(self):
+        self.id = None
+        self._finished = Event()
+        self._lock = Lock()
+        self._response = None
+        self._exception = None
+        self._cancelled = False
+        self._callbacks = []
+
+    def done(self):
+        return self._finished.is_set()
+
+    def cancelled(self):
+        return self._cancelled
+
+    def result(self, timeout=None):
+        if not self._finished.wait(timeout):
+            raise UploadTimeoutError('Upload %s not done after %s seconds' % (self.id, timeout))
+        if self._cancelled:
+            raise UploadCancelledError('Upload %s was canceled' % self.id)
+        if self._exception is not None:
+            raise self._exception
+        return self._response
+
+    def add_done_callback(self, fn):
+        self._lock.acquire(True)
+        try:
+            if not self.done():
+                self._callbacks.append(fn)
+                return
+        finally:
+            self._lock.release()
+        fn(self)
+
+    def finish(self, response=None, cancelled=False, exception=None):
+        self._lock.acquire(True)
+        try:
+            if self.done():
+                return
+            self._response = response
+            self._exception = exception
+            self._cancelled = cancelled
+            self._finished.set()
+            callbacks, self._callbacks = self._callbacks, []
+        finally:
+            self._lock.release()
+        for fn in callbacks:
+            fn(self)
+
+    def set_result(self, response):
+        self.finish(response=response)
+
+    def set_exception(self, exception):
+        self.finish(exception=exception)
+
+    def cancel(self):
+        self.finish(cancelled=True)
+
 
 class UploadQueueEntry(object):
-    def __init__(self, id, file):
+    __slots__ = ('id', 'file', 'future', 'priority', 'tenant', 'virtual_time', 'in_progress', 'cache_key',
+                 'cancelled', 'paused')
+
+    def __init__(self, id, file, future=None, priority=0, tenant=None):
         self.id = id
         self.file = file
+        self.future = future
+        self.priority = priority
+        self.tenant = tenant
+        self.virtual_time = 0       # see FairShareQueue
+        self.in_progress = False    # a worker is currently posting a chunk of this file
+        self.cache_key = None       # see UploadCache
+        self.cancelled = False
+        self.paused = False
+
+
+class FairShareQueue(object):
+    """
+    The uploads waiting for a worker, as a heap. Higher priority always goes first.
+    Within a priority, uploads are interleaved chunk by chunk so that each tenant gets
+    an equal share of the bytes, and each upload an equal share of its tenant's.
+
+    This is start-time fair queueing. Every upload carries a virtual_time. A new upload starts at
+    the queue's current virtual_time, the highest one popped so far, so it is served within a round.
+    Sending b bytes moves an upload's virtual_time on by b times the number of uploads its tenant
+    has going, and the lowest virtual_time is popped first. A small file is done within a round or
+    two instead of queueing behind a big one, and the big one still gets its share every round.
+
+    Canceled entries are left in the heap and skipped by the caller when popped.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.sequence = count()     # ties go to whoever was pushed first
+        self.virtual_time = 0
+        self.active = {}            # tenant -> uploads queued or in progress
+
+    def __len__(self):
+        return len(self.heap)
+
+    def add(self, entry):
+        """A new upload. Use push to put one back after a chunk."""
+        self.active[entry.tenant] = self.active.get(entry.tenant, 0) + 1
+        entry.virtual_time = self.virtual_time
+        self.push(entry)
+
+    def push(self, entry):
+        heappush(self.heap, (-entry.priority, entry.virtual_time, next(self.sequence), entry))
+
+    def pop(self):
+        entry = heappop(self.heap)[-1]
+        self.virtual_time = max(self.virtual_time, entry.virtual_time)
+        return entry
+
+    def charge(self, entry, bytes_sent):
+        entry.virtual_time += bytes_sent * self.active.get(entry.tenant, 1)
+
+    def remove(self, entry):
+        """An upload finished, failed or was canceled."""
+        self.active[entry.tenant] -= 1
+        if not self.active[entry.tenant]:
+            del self.active[entry.tenant]
+
+
+class UploadMetrics(object):
+    """
+    Counters for everything a LightweightUploader sends: request body bytes and chunks (retries
+    included), retries, uploads completed and failed, a histogram of how long each request took
+    from sending to response, and throughput over the last window seconds.
+
+    Every UploadableFile queued on the uploader records into the uploader's metrics, from
+    whichever thread posted the chunk, so the counters have a lock of their own.
+    lock_wait and lock_acquisitions are kept by LightweightUploader.acquire_lock, under the
+    uploader's lock, and need none.
+    """
+
+    # Upper bounds, in seconds, of the request latency histogram's buckets. The last is +Inf.
+    latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, window=10.0):
+        self.window = window
+        self.lock = Lock()
+        self.started = time()
+        self.bytes_sent = 0
+        self.chunks_sent = 0
+        self.retries = 0
+        self.uploads_completed = 0
+        self.uploads_failed = 0
+        self.latency_counts = [0] * (len(self.latency_buckets) + 1)
+        self.latency_sum = 0.0
+        self.recent = deque()       # (time, bytes) of the requests answered within the last window seconds
+        self.lock_wait = 0.0        # seconds spent waiting for the uploader's lock
+        self.lock_acquisitions = 0
+
+    def chunk_sent(self, bytes_sent, elapsed):
+        now = time()
+        self.lock.acquire(True)
+        try:
+            self.bytes_sent += bytes_sent
+            self.chunks_sent += 1
+            self.latency_counts[bisect_left(self.latency_buckets, elapsed)] += 1
+            self.latency_sum += elapsed
+            self.recent.append((now, bytes_sent))
+            self.expire(now)
+        finally:
+            self.lock.release()
+
+    def retried(self):
+        self.lock.acquire(True)
+        try:
+            self.retries += 1
+        finally:
+            self.lock.release()
+
+    def upload_finished(self, succeeded):
+        self.lock.acquire(True)
+        try:
+            if succeeded:
+                self.uploads_completed += 1
+            else:
+                self.uploads_failed += 1
+        finally:
+            self.lock.release()
+
+    def expire(self, now):
+        """Forget requests older than the window. Caller must hold self.lock."""
+        while self.recent and self.recent[0][0] <= now - self.window:
+            self.recent.popleft()
+
+    def throughput(self, now):
+        """Bytes per second over the last window seconds, or since we started if that's sooner. Caller must hold self.lock."""
+        self.expire(now)
+        elapsed = min(self.window, now - self.started)
+        if elapsed <= 0:
+            return 0.0
+        return sum(bytes_sent for sent_at, bytes_sent in self.recent) / elapsed
+
+    def snapshot(self):
+        """
+        The counters as a dict. latency_buckets is a list of (upper bound, count) with cumulative
+        counts, Prometheus style, ending with float('inf') and the total.
+        """
+        now = time()
+        self.lock.acquire(True)
+        try:
+            buckets = []
+            total = 0
+            for bound, bucket_count in zip(self.latency_buckets + (float('inf'),), self.latency_counts):
+                total += bucket_count
+                buckets.append((bound, total))
+            return {
+                'bytes_sent': self.bytes_sent,
+                'chunks_sent': self.chunks_sent,
+                'retries': self.retries,
+                'uploads_completed': self.uploads_completed,
+                'uploads_failed': self.uploads_failed,
+                'latency_buckets': buckets,
+                'latency_sum': self.latency_sum,
+                'latency_count': total,
+                'throughput': self.throughput(now),
+                'lock_wait': self.lock_wait,
+                'lock_acquisitions': self.lock_acquisitions,
+            }
+        finally:
+            self.lock.release()
+
+class CallbackDispatcher(object):
+    """
+    Calls on_progress and on_chunk callbacks from a thread of its own, so a slow callback
+    never holds up a worker, and no more than once per interval seconds for each upload and kind
+    of callback. Calls posted closer together than that are coalesced: only the latest arguments
+    are kept, and they are delivered when the interval is up, so the last call always gets through.
+
+    The thread is started by the first post() and sleeps on a condition whenever there's nothing due.
+    An exception from a callback is logged and otherwise ignored.
+    """
+
+    def __init__(self, interval=0.1, name='callbacks'):
+        self.interval = interval
+        self.name = name
+        self.lock = Condition()
+        self.pending = {}       # key -> [due, callback, args], at most one per key
+        self.last_called = {}   # key -> when its callback was last called, within the last interval
+        self.thread = None
+
+    def post(self, key, callback, *args):
+        self.lock.acquire(True)
+        try:
+            pending = self.pending.get(key)
+            if pending is not None:
+                pending[1:] = [callback, args]
+                return
+            due = max(time(), self.last_called.get(key, 0) + self.interval)
+            self.pending[key] = [due, callback, args]
+            if self.thread is None:
+                self.thread = Thread(target=self.run, name=self.name)
+                self.thread.daemon = True
+                self.thread.start()
+            self.lock.notify()
+        finally:
+            self.lock.release()
+
+    def next_due(self):
+        """
+        Pop the next call that is due, waiting for one if need be. Caller must hold self.lock.
+        """
+        while True:
+            if not self.pending:
+                now = time()
+                for key, called in self.last_called.items():
+                    if called <= now - self.interval:
+                        del self.last_called[key]
+                self.lock.wait()
+                continue
+            key, (due, callback, args) = min(self.pending.items(), key=lambda item: item[1][0])
+            now = time()
+            if due > now:
+                self.lock.wait(due - now)
+                continue
+            del self.pending[key]
+            self.last_called[key] = now
+            return callback, args
+
+    def run(self):
+        while True:
+            self.lock.acquire(True)
+            try:
+                callback, args = self.next_due()
+            finally:
+                self.lock.release()
+            try:
+                callback(*args)
+            except Exception:
+                warning('Callback %r raised an exception, ignoring it.', callback, exc_info=True)
 
 class LightweightUploader(Thread):
     """
@@ -77,17 +924,108 @@ class LightweightUploader(Thread):
 
     Does not support
     - User interface (this is a back-end only module)
-    - Concurrent upload of chunks. Our goal here is reliable, resumable uploads, not performance.
-      That said, the author has no objections to extending this to be more performant.
-      Current implementation uses the big-f'ing-lock approach.
+
+    Concurrency:
+    Several files may be uploaded at once: worker_count threads each claim a different queue entry.
+    upload_queue, a FairShareQueue, holds the entries waiting for a worker. A worker pops one, posts
+    a chunk and, if the file isn't finished, pushes it back, so uploads take turns by priority and
+    fair share rather than one file hogging the uploader. uploads maps every upload_id still queued
+    or in progress to its entry. Canceled entries are marked and skipped when popped rather than
+    searched for.
+    The lock only protects the queue; it is released while a chunk is on the wire.
+    A single file is only ever worked on by one worker at a time, so don't share one
+    http_connection between files when worker_count > 1.
+
+    A chunk that fails in a way worth retrying (see RetryPolicy) puts its upload aside in delayed
+    until its backoff is over, and workers carry on with the rest of the queue meanwhile.
+    An upload that fails for good is dropped from the queue after its on_complete is called.
+
+    Bandwidth can be capped for the whole uploader, per destination host or per upload with
+    set_rate_limit, at any time. Every block of every chunk is paid for from the global
+    TokenBucket, the host's and the upload's own, if it has one.
+
+    set_enabled(False) pauses the whole uploader and pause_upload(id) a single upload. Either way the
+    chunk in flight is finished and nothing more is sent until resumed; a paused upload's entry is
+    parked in paused, where no worker looks at it. Resuming carries on from what the server has
+    confirmed. Pausing the uploader also closes the pool's idle connections.
+
+    Given a journal, an UploadJournal, every upload of a file on disk is recorded there as it
+    progresses. The uploads it still holds are queued again, resuming where they were, when the
+    uploader is started, or earlier by calling replay_journal yourself.
+
+    Unless given an http_connection, uploads borrow keep-alive connections from connection_pool,
+    a ConnectionPool, for each request. Pass your own pool to change its size or idle timeout.
+
+    enqueue_many and enqueue_directory queue lots of files at once, taking the lock once per batch,
+    or lazily, a batch at a time as workers run out of uploads.
+
+    A queued upload of a file on disk takes about 1.3K of memory, its file name included. Uploads to the
+    same upload_url and additional_data share one parsed URL (see parsed_url). Measured with
+    bench_py_lightweight_uploader.py --memory 100000, on 64-bit Linux.
+
+    Files on disk, and the temporary files compressed uploads are spooled to, are only held open while
+    a chunk of them is being sent, or until file_handles, a FileHandleCache of at most max_open_files,
+    needs the room, so any number of files can be queued.
+
+    Given a cache, an UploadCache, a file with the same content, destination and destination_filename
+    as one already queued isn't queued again: it gets that upload's upload_id and its on_complete is
+    called with the same response. One uploaded successfully within the cache's ttl isn't uploaded
+    at all; its on_complete is called right away with the earlier response.
+
+    on_progress and on_chunk callbacks are called from callbacks, a CallbackDispatcher, at most
+    once every callback_interval seconds per upload. on_complete is still called by the worker.
+
+    Redirects (301, 302, 307 and 308) are followed by re-sending the chunk, Session-ID and all, to the
+    Location given. Permanent ones are remembered in redirect_cache, a RedirectCache, and uploads queued
+    to the old place are sent to the new one from their first request on.
+
+    Every request of every upload is counted in metrics, an UploadMetrics. snapshot() adds the
+    queue depth and each upload's progress to those counters, and prometheus_text() formats it all
+    for a Prometheus scrape.
 
     """
 
-    def __init__(self, group=None, target=None, name='theLightweightUploader', args=(), kwargs={}):
+    def __init__(self, group=None, target=None, name='theLightweightUploader', args=(), kwargs={}, worker_count=1,
+                 connection_pool=None, journal=None, retry_policy=None, metrics=None, callback_interval=0.1,
+                 cache=None, max_open_files=256, redirect_cache=None):
         super(LightweightUploader, self).__init__(group=group, target=target, name=name, *args, **kwargs)
         self.daemon = True
-        self.upload_queue = []
+        self.upload_queue = FairShareQueue()
+        self.uploads = {}
         self.lock = Lock()
+        self.work_available = Condition(self.lock)     # something was queued or handed back by a worker
+        self.upload_finished = Condition(self.lock)    # something left the queue
+        if worker_count < 1:
+            raise ValueError('worker_count must be at least 1, got %r' % worker_count)
+        self.worker_count = worker_count
+        self.workers = []
+        self.connection_pool = connection_pool if connection_pool is not None else ConnectionPool()
+        self.journal = journal
+        self.journal_replayed = False
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self.delayed = []                   # heap of (retry_at, sequence, entry) waiting out a backoff
+        self.delayed_sequence = count()
+        self.rate_limit = TokenBucket()
+        self.host_rate_limits = {}          # netloc -> TokenBucket
+        self.enabled = True
+        self.paused = {}                    # upload_id -> entry of uploads paused by pause_upload
+        self.metrics = metrics if metrics is not None else UploadMetrics()
+        self.callbacks = CallbackDispatcher(callback_interval, name='%s-callbacks' % name)
+        self.cache = cache
+        self.file_handles = FileHandleCache(max_open_files)
+        self.redirect_cache = redirect_cache if redirect_cache is not None else RedirectCache()
+        self.parsed_urls = {}               # (upload_url, additional_data items) -> ParseResult, see parsed_url
+        self.sources = []                   # (iterator of UploadableFiles, batch_size, priority, tenant) from enqueue_many
+        self.source_lock = Lock()           # one worker at a time takes a batch from sources
+
+    def acquire_lock(self):
+        """
+        self.lock.acquire(True), adding the time it took to metrics.lock_wait.
+        """
+        started = time()
+        self.lock.acquire(True)
+        self.metrics.lock_wait += time() - started
+        self.metrics.lock_acquisitions += 1
 
     def enqueue_upload(self,
                        file_name,
@@ -96,118 +1034,970 @@ class LightweightUploader(Thread):
                        http_connection=None,
                        destination_filename=None,
                        on_complete=None,
-                       content=None
+                       content=None,
+                       parallel_chunks=1,
+                       chunk_size_policy=None,
+                       simple_upload_threshold=None,
+                       retry_policy=None,
+                       priority=0,
+                       tenant=None,
+                       on_progress=None,
+                       on_chunk=None,
+                       compression=None
             ):
         """
         Add file_object to the upload queue. Returns an upload_id.
 
-        file_name: The name file to be uploaded
-        upload_url: The absolute URL to which the file should be uploaded
-        additional_data: Additional data to be passed to the server in the query string as GET parameters
-        http_connection: optional, but if given, the HttpConnection object to use for sending
-        destination_filename: name file should be uploaded to. If None, defaults to current filename.
-        on_complete: called when the upload completes and given response=HttpResponse object.
-        content: override the content of the file. If a seekable/readable object, treat as filehandle.
-          Otherwise, treat it as a string.
+        file_name: The name file to be uploaded
+        upload_url: The absolute URL to which the file should be uploaded, or a DestinationGroup
+          of URLs to spread uploads across
+        additional_data: Additional data to be passed to the server in the query string as GET parameters
+        http_connection: optional, but if given, the HttpConnection object to use for sending
+          instead of one from connection_pool
+        destination_filename: name file should be uploaded to. If None, defaults to current filename.
+        on_complete: called when the upload completes and given response=HttpResponse object.
+        content: override the content of the file. If a seekable/readable object, treat as filehandle.
+          Otherwise, treat it as a string.
+        parallel_chunks: how many chunks of this file may be in flight at once. See UploadableFile.
+        chunk_size_policy: how the chunk size adapts to the link, e.g. AdaptiveChunkSize(). See UploadableFile.
+        simple_upload_threshold: files up to this many bytes are sent in one plain POST. See UploadableFile.
+        retry_policy: when and how often to retry after a failure, a RetryPolicy. Defaults to the uploader's.
+        priority: uploads with a higher priority are always sent first. Defaults to 0.
+        tenant: uploads are shared out fairly between tenants, see FairShareQueue.
+          Defaults to the destination host.
+        on_progress: called as on_progress(upload_id, bytes_confirmed, total_bytes) as the server
+          confirms more of the file. Coalesced, see CallbackDispatcher.
+        on_chunk: called as on_chunk(upload_id, (first, last), seconds) with the inclusive byte range of
+          each request the server answered and how long it took. Coalesced, see CallbackDispatcher.
+        compression: a codec such as GzipCodec() to compress the file with before sending it. See UploadableFile.
+        """
+
+        url, additional_data = self.destination(upload_url, additional_data)
+        return self.enqueue_file(
+            UploadableFile(
+                file_name,
+                url,
+                additional_data=additional_data,
+                http_connection=http_connection,
+                connection_pool=self.connection_pool,
+                destination_filename=destination_filename,
+                on_complete=on_complete,
+                content=content,
+                parallel_chunks=parallel_chunks,
+                chunk_size_policy=chunk_size_policy,
+                simple_upload_threshold=simple_upload_threshold,
+                retry_policy=retry_policy if retry_policy is not None else self.retry_policy,
+                on_progress=on_progress,
+                on_chunk=on_chunk,
+                compression=compression
+            ),
+            priority=priority,
+            tenant=tenant
+        )
+
+    def enqueue_file(self, file, future=None, id=None, priority=0, tenant=None):
+        """
+        Add an UploadableFile to the upload queue. Returns an upload_id.
+        Raises ValueError if given the id of an upload that is already queued.
+        """
+        if id is not None:
+            self.acquire_lock()
+            try:
+                if id in self.uploads:
+                    raise ValueError('Upload %s is already queued' % id)
+            finally:
+                self.lock.release()
+        id = id if id is not None else uuid4()
+        if future is not None:
+            future.id = id
+            on_complete = file.on_complete
+            def resolve(response):
+                try:
+                    if on_complete:
+                        on_complete(response=response)
+                finally:
+                    future.set_result(response)
+            file.on_complete = resolve
+
+        cache_key = None
+        if self.cache is not None:
+            try:
+                cache_key = self.cache.key(file)
+            except (IOError, OSError):
+                warning('Could not hash %s, uploading it regardless.', file.file_name, exc_info=True)
+        response = None
+        if cache_key is not None:
+            self.acquire_lock()
+            try:
+                in_flight = self.cache.in_flight.get(cache_key)
+                if in_flight is not None:
+                    info('%s is already being uploaded to %s, id: %s', file.file_name, file.destination, in_flight[0])
+                    in_flight[1].append((file, future))
+                    if future is not None:
+                        future.id = in_flight[0]
+                    return in_flight[0]
+                response = self.cache.get(cache_key)
+                if response is None:
+                    self.cache.in_flight[cache_key] = (id, [])
+            finally:
+                self.lock.release()
+        if response is not None:
+            info('%s was uploaded to %s already, not uploading it again.', file.file_name, file.destination)
+            self.complete_duplicates([(file, future)], response)
+            return id
+
+        # Only now, so a duplicate never takes a host of a DestinationGroup it won't upload to.
+        self.prepare_file(file, id)
+        tenant = tenant if tenant is not None else file.destination_url.netloc
+
+        if self.journal is not None:
+            self.journal.record(id, file)
+        self.acquire_lock()
+        try:
+            info('Queueing %s for upload to %s, id: %s', file.file_name, urlunparse(file.destination_url), id)
+            entry = UploadQueueEntry(id, file, future, priority, tenant)
+            entry.cache_key = cache_key
+            self.uploads[id] = entry
+            self.upload_queue.add(entry)
+            self.work_available.notify()
+        finally:
+            self.lock.release()
+        return id
+
+    def parsed_url(self, upload_url, additional_data=None):
+        """
+        upload_url parsed, with additional_data folded into its query. The same upload_url and
+        additional_data give the same ParseResult, so uploads queued to one place share it.
+        """
+        if isinstance(upload_url, ParseResult):
+            return fold_additional_data(upload_url, additional_data)
+        try:
+            key = (upload_url, tuple(sorted(additional_data.items())) if additional_data else None)
+            url = self.parsed_urls.get(key)
+        except (AttributeError, TypeError):     # additional_data is a list of pairs, or has lists in it
+            return fold_additional_data(urlparse(upload_url), additional_data)
+        if url is None:
+            if len(self.parsed_urls) >= 1024:
+                self.parsed_urls.clear()
+            url = self.parsed_urls[key] = fold_additional_data(urlparse(upload_url), additional_data)
+        return url
+
+    def destination(self, upload_url, additional_data=None):
+        """
+        (destination_url, additional_data) to make an UploadableFile with: upload_url parsed with
+        additional_data folded in, or a DestinationGroup as it is, to fold it into each upload's host.
+        """
+        if isinstance(upload_url, DestinationGroup):
+            return upload_url, additional_data
+        return self.parsed_url(upload_url, additional_data), None
+
+    def prepare_file(self, file, id):
+        file.redirect_cache = self.redirect_cache
+        if file.destination_url is None:
+            file.choose_destination(id)
+        file.file_handles = self.file_handles
+        file.throttles = [self.rate_limit, self.host_rate_limit(file.destination_url.netloc)]
+        file.metrics = self.metrics
+        file.upload_id = id
+        file.callbacks = self.callbacks
+
+    def enqueue_many(self, file_names, upload_url, additional_data=None, lazy=False, batch_size=1000,
+                     priority=0, tenant=None, **kwargs):
+        """
+        Queue every file in file_names, any iterable, for upload to upload_url. The rest of the arguments
+        are the same as enqueue_upload's, and go for every file. The URL is only parsed once, and the files
+        are queued batch_size at a time, each batch under one acquisition of the lock and, if there's a
+        journal, in one transaction. Returns the upload_ids.
+
+        With lazy=True, nothing is queued yet and None is returned. Workers take the next batch_size
+        files from file_names whenever they run out of uploads, so only a batch or so is in memory
+        at once, however many file_names has. wait_all waits for those too. Lazily queued files have
+        no upload_id until they are taken; on_progress and on_chunk are told theirs.
+        """
+        url, additional_data = self.destination(upload_url, additional_data)
+        kwargs.setdefault('retry_policy', self.retry_policy)
+        files = (UploadableFile(file_name, url, additional_data=additional_data,
+                                connection_pool=self.connection_pool, **kwargs)
+                 for file_name in file_names)
+        if lazy:
+            self.acquire_lock()
+            try:
+                self.sources.append((files, batch_size, priority, tenant))
+                self.work_available.notify_all()
+            finally:
+                self.lock.release()
+            return None
+        ids = []
+        while True:
+            batch = list(islice(files, batch_size))
+            if not batch:
+                return ids
+            ids += self.enqueue_batch(batch, priority, tenant)
+
+    def enqueue_directory(self, path, upload_url, pattern='*', **kwargs):
+        """
+        Lazily queue every file in directory path whose name matches pattern, a glob such as '*.json',
+        for upload to upload_url. Takes the same arguments as enqueue_many, and returns right away.
+        """
+        kwargs.setdefault('lazy', True)
+        file_names = (file_name for file_name in iglob(join(path, pattern)) if isfile(file_name))
+        return self.enqueue_many(file_names, upload_url, **kwargs)
+
+    def enqueue_batch(self, files, priority=0, tenant=None):
+        """
+        Queue a list of UploadableFiles, taking the lock once. Returns their upload_ids.
+        With a cache, each file has to be hashed and looked up, so they go through enqueue_file one by one.
+        """
+        if self.cache is not None:
+            return [self.enqueue_file(file, priority=priority, tenant=tenant) for file in files]
+        ids = [uuid4() for file in files]
+        for id, file in zip(ids, files):
+            self.prepare_file(file, id)
+        if self.journal is not None:
+            self.journal.record_many(zip(ids, files))
+        self.acquire_lock()
+        try:
+            info('Queueing %d files for upload, the first to %s', len(files), urlunparse(files[0].destination_url))
+            for id, file in zip(ids, files):
+                entry = UploadQueueEntry(id, file, None, priority,
+                                         tenant if tenant is not None else file.destination_url.netloc)
+                self.uploads[id] = entry
+                self.upload_queue.add(entry)
+            self.work_available.notify_all()
+        finally:
+            self.lock.release()
+        return ids
+
+    def refill(self):
+        """
+        Queue the next batch of the first lazy source from enqueue_many, dropping it once it runs dry.
+        Called by a worker that found nothing to do, without holding self.lock.
+        """
+        self.source_lock.acquire(True)
+        try:
+            if not self.sources:
+                return
+            files, batch_size, priority, tenant = self.sources[0]
+            try:
+                batch = list(islice(files, batch_size))
+            except Exception:
+                critical('Giving up on a batch of files that could not be listed', exc_info=True)
+                batch = []
+            if batch:
+                self.enqueue_batch(batch, priority, tenant)
+            if len(batch) < batch_size:
+                self.acquire_lock()
+                try:
+                    self.sources.pop(0)
+                    self.upload_finished.notify_all()   # might have been all wait_all was waiting for
+                finally:
+                    self.lock.release()
+        finally:
+            self.source_lock.release()
+
+    def forget_in_flight(self, entry, completed=False):
+        """
+        Take entry out of cache.in_flight, remembering its response in the cache if it completed.
+        Returns the (file, future) pairs of the duplicates that were waiting on it. Caller must hold self.lock.
+        """
+        if entry.cache_key is None:
+            return []
+        upload_id, duplicates = self.cache.in_flight.pop(entry.cache_key, (None, []))
+        if completed and entry.file.response is not None and 200 == entry.file.response.status:
+            self.cache.put(entry.cache_key, entry.file.response)
+        return duplicates
+
+    @staticmethod
+    def complete_duplicates(duplicates, response):
+        """
+        Call on_complete of each duplicate with response. One that raises doesn't stop the rest, or the worker.
+        """
+        for file, future in duplicates:
+            file.response = response
+            if file.on_complete:
+                try:
+                    file.on_complete(response=response)
+                except Exception:
+                    warning('on_complete of %s raised an exception, ignoring it.', file.file_name, exc_info=True)
+
+    def host_rate_limit(self, host):
+        bucket = self.host_rate_limits.get(host)
+        if bucket is None:
+            bucket = self.host_rate_limits.setdefault(host, TokenBucket())
+        return bucket
+
+    def set_rate_limit(self, rate, burst=None, host=None, upload_id=None):
+        """
+        Limit uploads to rate bytes per second, or lift the limit with rate=None.
+        With neither host nor upload_id, this is the limit for everything together.
+        host (a netloc like 'example.com:8080') limits all uploads to that host together,
+        and upload_id just the one upload. Takes effect from the next block sent.
+        burst is how many bytes may go at once after a quiet spell; a second's worth by default.
+        """
+        if upload_id is not None:
+            self.acquire_lock()
+            try:
+                entry = self.uploads.get(upload_id)
+                if entry is None:
+                    return
+                if entry.file.rate_limit is None:
+                    entry.file.rate_limit = TokenBucket(rate, burst)
+                    entry.file.throttles.append(entry.file.rate_limit)
+                else:
+                    entry.file.rate_limit.set_rate(rate, burst)
+            finally:
+                self.lock.release()
+        elif host is not None:
+            self.host_rate_limit(host).set_rate(rate, burst)
+        else:
+            self.rate_limit.set_rate(rate, burst)
+
+    def replay_journal(self, on_complete=None):
+        """
+        Queue every upload left in the journal again, under its old upload_id and Session-ID,
+        starting from the byte ranges the server had confirmed. Returns the upload_ids.
+        on_complete, if given, is used for all of them, since callbacks can't be journaled.
+        Happens by itself in start(), unless you've already called it. Uploads that are
+        already queued, as every one queued before then is, are left as they are.
+        """
+        self.journal_replayed = True
+        ids = []
+        if self.journal is None:
+            return ids
+        for id, file_name, url, destination_filename, session_id, received_ranges in self.journal.entries():
+            if id in self.uploads:
+                continue
+            info('Resuming upload %s of %s from the journal, server had %s', id, file_name, received_ranges)
+            file = UploadableFile(
+                file_name,
+                url,
+                connection_pool=self.connection_pool,
+                destination_filename=destination_filename,
+                on_complete=on_complete,
+                session_id=session_id,
+                received_ranges=received_ranges,
+                retry_policy=self.retry_policy
+            )
+            ids.append(self.enqueue_file(file, id=id))
+        return ids
+
+    def submit_upload(self, file_name, upload_url, **kwargs):
+        """
+        Same arguments as enqueue_upload, but returns an UploadFuture for the final response
+        instead of an upload_id (the future's id attribute has that). on_complete is still called.
+        """
+        future = UploadFuture()
+        priority = kwargs.pop('priority', 0)
+        tenant = kwargs.pop('tenant', None)
+        kwargs.setdefault('retry_policy', self.retry_policy)
+        url, additional_data = self.destination(upload_url, kwargs.pop('additional_data', None))
+        file = UploadableFile(file_name, url, additional_data=additional_data,
+                              connection_pool=self.connection_pool, **kwargs)
+        self.enqueue_file(file, future, priority=priority, tenant=tenant)
+        return future
+
+    def enqueueUpload(self, *args):
+        """
+        API compatability. Use enqueue_upload instead please.
+        """
+        self.enqueue_upload(*args)
+
+    def cancel_upload(self, id):
+        """
+        Cancel the upload with given upload_id. If the upload is in progress, it will be not be continued.
+        Upload item is removed from the internal queue.
+
+        upload_id: the id of the upload to be canceled.
+
+        Uploads of the same content coalesced onto this one (see UploadCache) are someone else's,
+        so they are queued again, the first as a new upload and the rest as its duplicates.
+        Their futures get the new upload_id.
+        """
+        duplicates = []
+        self.acquire_lock()
+        try:
+            entry = self.uploads.pop(id, None)
+            self.paused.pop(id, None)
+            if entry is not None:
+                entry.cancelled = True      # claim_next_entry throws it away when it gets to it
+                if not entry.in_progress:
+                    entry.file.close()      # otherwise the worker does, once its chunk is done
+                duplicates = self.forget_in_flight(entry)
+                self.upload_queue.remove(entry)
+                if entry.file.retry_at > time():
+                    # don't leave workers waking up for its backoff; there are never many of these
+                    self.delayed = [d for d in self.delayed if d[2] is not entry]
+                    heapify(self.delayed)
+                    self.work_available.notify_all()
+                if entry.future is not None:
+                    entry.future.cancel()
+                self.upload_finished.notify_all()
+        finally:
+            self.lock.release()
+        if self.journal is not None:
+            self.journal.remove(id)
+        for file, future in duplicates:
+            new_id = self.enqueue_file(file)        # on_complete already resolves future
+            info('Upload %s was canceled, its duplicate %s is upload %s now', id, file.file_name, new_id)
+            if future is not None:
+                future.id = new_id
+
+    def cancelUpload(self, *args):
+        """
+        API compatability. Use enqueue_upload instead please.
+        """
+        self.cancel_upload(*args)
+
+    def set_enabled(self, enabled):
+        """
+        Pause (False) or resume (True) all uploading. Chunks already on the wire are finished,
+        then workers sleep until re-enabled. Uploads can still be queued and canceled meanwhile.
+        """
+        self.acquire_lock()
+        try:
+            self.enabled = enabled
+            self.work_available.notify_all()
+        finally:
+            self.lock.release()
+        if not enabled:
+            info('Pausing uploads.')
+            self.connection_pool.close_idle()
+
+    def pause_upload(self, id):
+        """
+        Stop sending the upload with given upload_id, after the chunk in flight if there is one.
+        """
+        self.acquire_lock()
+        try:
+            entry = self.uploads.get(id)
+            if entry is not None:
+                entry.paused = True
+        finally:
+            self.lock.release()
+
+    def resume_upload(self, id):
+        """
+        Carry on with an upload stopped by pause_upload.
+        """
+        self.acquire_lock()
+        try:
+            entry = self.uploads.get(id)
+            if entry is None:
+                return
+            entry.paused = False
+            if self.paused.pop(id, None) is not None:
+                self.requeue(entry)
+                self.work_available.notify()
+        finally:
+            self.lock.release()
+
+    def requeue(self, entry):
+        """
+        Put an entry back for the workers, or aside until its backoff is over. Caller must hold self.lock.
+        """
+        if entry.file.retry_at > time():
+            heappush(self.delayed, (entry.file.retry_at, next(self.delayed_sequence), entry))
+        else:
+            self.upload_queue.push(entry)
+
+    def setEnabled(self, *args):
+        self.set_enabled(*args)
+
+    def start(self):
+        """
+        Replay the journal, if it hasn't been, then start the workers. The replay happens here, on the
+        caller's thread, so it is over before anything queued after start() is written to the journal.
+        """
+        if not self.journal_replayed:
+            self.replay_journal()
+        super(LightweightUploader, self).start()
+
+    def run(self):
+        for i in range(1, self.worker_count):
+            worker = Thread(target=self.work, name='%s-worker-%d' % (self.name, i))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+        self.work()
+
+    def claim_next_entry(self):
+        """
+        Take the next entry off upload_queue, marking it in_progress. Uploads whose backoff
+        is over go back into the queue first, and paused ones are parked in self.paused.
+        Returns None if there is nothing to do or the uploader is disabled. Caller must hold self.lock.
+        """
+        if not self.enabled:
+            return None
+        now = time()
+        while self.delayed and self.delayed[0][0] <= now:
+            self.upload_queue.push(heappop(self.delayed)[2])
+        while self.upload_queue:
+            entry = self.upload_queue.pop()
+            if entry.cancelled:
+                continue
+            if entry.paused:
+                self.paused[entry.id] = entry
+                continue
+            entry.in_progress = True
+            return entry
+        return None
+
+    def work(self):
+        try:
+            while True:
+                self.acquire_lock()
+                try:
+                    entry = self.claim_next_entry()
+                    while entry is None and not (self.sources and self.enabled):
+                        debug('Upload queue has nothing waiting for a worker.')
+                        if self.delayed and self.enabled:
+                            self.work_available.wait(max(0, self.delayed[0][0] - time()))
+                        else:
+                            self.work_available.wait()
+                        entry = self.claim_next_entry()
+                finally:
+                    self.lock.release()
+                if entry is None:
+                    self.refill()
+                    continue
+
+                r = None
+                duplicates = []
+                bytes_posted = entry.file.bytes_posted
+                try:
+                    r = entry.file.post_next_chunk()    # the slow part, done without holding the lock
+                except Exception as e:
+                    critical('Giving up on %s, id: %s', entry.file.file_name, entry.id, exc_info=True)
+                    r = -1
+                    if entry.future is not None:
+                        entry.future.set_exception(e)
+                finally:
+                    # Before the entry leaves uploads, so whoever is in wait_all sees the journal up to date.
+                    if self.journal is not None and not entry.cancelled:
+                        if r > 0:
+                            self.journal.update(entry.id, entry.file)
+                        elif r is not None:
+                            self.journal.remove(entry.id)
+                    self.acquire_lock()
+                    try:
+                        entry.in_progress = False
+                        if entry.cancelled:
+                            debug('Upload %s was canceled, dropping it.', entry.id)
+                        elif 0 == r:  # finished uploading. Yay!
+                            info('Completed uploading %s', entry.file.file_name)
+                            self.metrics.upload_finished(True)
+                            duplicates = self.forget_in_flight(entry, completed=True)
+                            self.uploads.pop(entry.id, None)
+                            self.upload_queue.remove(entry)
+                            self.upload_finished.notify_all()
+                        elif r > 0 and entry.paused:
+                            debug('Upload %s paused.', entry.id)
+                            self.paused[entry.id] = entry
+                        elif r > 0 and entry.file.retry_at > time(): # backing off, let the others go first
+                            self.requeue(entry)
+                            self.work_available.notify()
+                        elif r > 0: # I uploaded a single chunk, carrying on...
+                            debug('Uploaded a chunk, continuing to upload %s', entry.file.file_name)
+                            self.upload_queue.charge(entry, entry.file.bytes_posted - bytes_posted)
+                            self.upload_queue.push(entry)
+                            self.work_available.notify()
+                        elif r < 0: # Upload failed for good.
+                            warning('Failed to upload %s, id: %s', entry.file.file_name, entry.id)
+                            self.metrics.upload_finished(False)
+                            duplicates = self.forget_in_flight(entry)
+                            self.uploads.pop(entry.id, None)
+                            self.upload_queue.remove(entry)
+                            self.upload_finished.notify_all()
+                        else:       # post_next_chunk blew up, put it back where it was
+                            self.upload_queue.push(entry)
+                    finally:
+                        self.lock.release()
+                    if entry.cancelled or (r is not None and r < 0):
+                        entry.file.close()
+                    if duplicates:
+                        self.complete_duplicates(duplicates, entry.file.response)
+                    if not self.enabled:
+                        self.connection_pool.close_idle()   # the one we just gave back
+        finally:
+            self.acquire_lock()
+            try:
+                self.upload_finished.notify_all()   # so wait_all notices if this was the last thread
+            finally:
+                self.lock.release()
+
+    def snapshot(self):
         """
-
-        self.lock.acquire(True)
+        The metrics counters (see UploadMetrics.snapshot) plus how many uploads are queued,
+        in progress, backing off and paused, and the progress of each upload by upload_id.
+        """
+        self.acquire_lock()
         try:
-            id = uuid4()
-            url = fold_additional_data(urlparse(upload_url), additional_data)
-            info('Queueing %s for upload to %s, id: %s', file_name, upload_url, id)
-            self.upload_queue.append(
-                UploadQueueEntry(
-                    id,
-                    UploadableFile(
-                        file_name,
-                        url,
-                        additional_data=None,
-                        http_connection=http_connection,
-                        destination_filename=destination_filename,
-                        on_complete=on_complete,
-                        content=content
-                    )
-                )
-            )
+            entries = self.uploads.values()
+            in_progress = sum(1 for entry in entries if entry.in_progress)
+            delayed = len(self.delayed)
+            paused = len(self.paused)
+            snapshot = self.metrics.snapshot()
         finally:
             self.lock.release()
-        return id
+        snapshot['uploads_in_progress'] = in_progress
+        snapshot['uploads_delayed'] = delayed
+        snapshot['uploads_paused'] = paused
+        snapshot['uploads_queued'] = len(entries) - in_progress - delayed - paused
+        snapshot['uploads'] = dict((entry.id, entry.file.progress) for entry in entries)
+        return snapshot
 
-    def enqueueUpload(self, *args):
+    def prometheus_text(self, prefix='lightweight_uploader'):
         """
-        API compatability. Use enqueue_upload instead please.
+        snapshot() in the Prometheus text exposition format.
         """
-        self.enqueue_upload(*args)
+        snapshot = self.snapshot()
+        lines = []
+        def metric(name, type, help, samples):
+            lines.append('# HELP %s_%s %s' % (prefix, name, help))
+            lines.append('# TYPE %s_%s %s' % (prefix, name, type))
+            for suffix, labels, value in samples:
+                labels = ','.join('%s="%s"' % label for label in labels)
+                value = ('%r' if isinstance(value, float) else '%d') % value
+                lines.append('%s_%s%s%s %s' % (prefix, name, suffix, '{%s}' % labels if labels else '', value))
+        metric('bytes_sent_total', 'counter', 'Request body bytes sent, retries included.',
+               [('', (), snapshot['bytes_sent'])])
+        metric('chunks_sent_total', 'counter', 'Requests answered by the server.',
+               [('', (), snapshot['chunks_sent'])])
+        metric('retries_total', 'counter', 'Failed requests that were retried.',
+               [('', (), snapshot['retries'])])
+        metric('uploads_finished_total', 'counter', 'Uploads finished, by outcome.',
+               [('', (('outcome', 'completed'),), snapshot['uploads_completed']),
+                ('', (('outcome', 'failed'),), snapshot['uploads_failed'])])
+        metric('request_seconds', 'histogram', 'Time from sending a request to its response.',
+               [('_bucket', (('le', '+Inf' if bound == float('inf') else repr(bound)),), bucket_count)
+                for bound, bucket_count in snapshot['latency_buckets']]
+               + [('_sum', (), snapshot['latency_sum']), ('_count', (), snapshot['latency_count'])])
+        metric('throughput_bytes_per_second', 'gauge', 'Bytes sent per second, recently.',
+               [('', (), snapshot['throughput'])])
+        metric('uploads', 'gauge', 'Uploads not finished yet, by state.',
+               [('', (('state', state),), snapshot['uploads_' + state])
+                for state in ('queued', 'in_progress', 'delayed', 'paused')])
+        metric('lock_wait_seconds_total', 'counter', 'Time spent waiting for the upload queue lock.',
+               [('', (), snapshot['lock_wait'])])
+        metric('upload_bytes_done', 'gauge', 'Bytes of each upload the server has confirmed.',
+               [('', (('upload_id', id),), done) for id, (done, total) in snapshot['uploads'].items()])
+        metric('upload_bytes_total', 'gauge', 'Size of each upload.',
+               [('', (('upload_id', id),), total) for id, (done, total) in snapshot['uploads'].items()
+                if total is not None])
+        return '\n'.join(lines) + '\n'
 
-    def cancel_upload(self, id):
+    @property
+    def is_done(self):
+        return ( not self.is_alive() ) or (len(self.uploads) < 1 and not self.sources)
+
+    def is_upload_done(self, id):
         """
-        Cancel the upload with given upload_id. If the upload is in progress, it will be not be continued.
-        Upload item is removed from the internal queue.
+        True once the upload with given upload_id has finished, failed or been canceled.
+        """
+        return id not in self.uploads
 
-        upload_id: the id of the upload to be canceled.
+    def wait_for(self, predicate, timeout):
         """
-        self.lock.acquire(True)
+        Block until predicate() is true, checking each time an upload leaves the queue.
+        Returns False if timeout seconds went by first. Caller must hold self.lock.
+        """
+        deadline = None if timeout is None else time() + timeout
+        while not predicate():
+            if deadline is None:
+                self.upload_finished.wait()
+            else:
+                remaining = deadline - time()
+                if remaining <= 0:
+                    return False
+                self.upload_finished.wait(remaining)
+        return True
+
+    def wait_all(self, timeout=None):
+        """
+        Block until the upload queue is empty (or the uploader has died).
+        Returns False if that didn't happen within timeout seconds, otherwise True.
+        """
+        self.acquire_lock()
         try:
-            self.upload_queue = [x for x in self.upload_queue if x.id != id]
+            return self.wait_for(lambda: self.is_done, timeout)
         finally:
             self.lock.release()
 
-    def cancelUpload(self, *args):
+    def join_upload(self, id, timeout=None):
         """
-        API compatability. Use enqueue_upload instead please.
+        Block until the upload with given upload_id has finished or been canceled.
+        Returns False if that didn't happen within timeout seconds, otherwise True.
         """
-        self.cancel_upload(*args)
+        self.acquire_lock()
+        try:
+            return self.wait_for(lambda: not self.is_alive() or self.is_upload_done(id), timeout)
+        finally:
+            self.lock.release()
 
-    def set_enabled(self, enabled):
-        """
-        Not implemented since it appears to be UI related.
-        Maybe what this wants to be is a way to pause the uploader?
-        """
-        raise NotImplementedError('UI functionality is not implemented in this module.')
+class ChunkReader(object):
+    """
+    Read-only, file-like view of bytes first..last (inclusive) of source, used as a request body.
+    HTTPConnection sends anything with a read() method in 8k blocks and takes Content-Length
+    from len(), so only one block of a chunk is ever in memory, however big the chunk is.
 
-    def setEnabled(self, *args):
-        self.set_enabled(*args)
+    source is either a memoryview, which is sliced without copying, or a seekable file.
+    Readers of the same file share lock, since every block is a seek followed by a read.
+    Each block is paid for from every TokenBucket in throttles before it is handed over,
+    which is what holds the upload to its rate limits.
+    """
 
-    def run(self):
-        while True:
+    def __init__(self, source, first, last, lock=None, throttles=()):
+        self.source = source
+        self.first = first
+        self.last = last
+        self.position = first
+        self.lock = lock if lock is not None else Lock()
+        self.throttles = throttles
+
+    def __len__(self):
+        return self.last - self.first + 1
+
+    def rewind(self):
+        self.position = self.first
+
+    def read(self, size=-1):
+        remaining = self.last - self.position + 1
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        if size <= 0:
+            return ''
+        if isinstance(self.source, memoryview):
+            block = self.source[self.position:self.position + size]
+        else:
             self.lock.acquire(True)
-            if len(self.upload_queue) < 1:
-                self.lock.release()
-                debug('Upload queue is empty.')
-                sleep(0.1)
-                continue
             try:
-                top_of_queue = self.upload_queue[0].file
-                r = top_of_queue.post_next_chunk()
-                if 0 == r:  # finished uploading. Yay!
-                    info('Completed uploading %s', top_of_queue.file_name)
-                    self.upload_queue = self.upload_queue[1:]
-                elif r > 0: # I uploaded a single chunk, carrying on...
-                    debug('Uploaded a chunk, continuing to upload %s', top_of_queue.file_name)
-                elif r < 0: # Upload of a chunk failed.
-                    debug('Failed to upload a chunk.')
-                    raise Exception('bonk')
+                self.source.seek(self.position)
+                block = self.source.read(size)
             finally:
                 self.lock.release()
+        for throttle in self.throttles:
+            throttle.consume(len(block))
+        self.position += len(block)
+        return block
 
-    @property
-    def is_done(self):
-        return ( not self.is_alive() ) or len(self.upload_queue) < 1
+class TokenBucket(object):
+    """
+    Limits a byte rate. Tokens trickle in at rate bytes per second, up to burst of them
+    (a second's worth by default), and consume() waits until there are enough.
+    A rate of None means no limit. set_rate can be called at any time, from any thread.
+
+    Waiting is done by going into debt: consume takes the tokens straight away, possibly
+    going negative, and then sleeps, without the lock, for as long as the debt takes to pay off.
+    Concurrent senders thereby line up behind each other without polling.
+    """
+
+    def __init__(self, rate=None, burst=None):
+        self.lock = Lock()
+        self.rate = None
+        self.tokens = 0
+        self.updated = time()
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst=None):
+        if rate is not None and rate <= 0:
+            raise ValueError('rate must be positive or None, got %r' % rate)
+        self.lock.acquire(True)
+        try:
+            self.refill()
+            self.rate = rate
+            self.burst = burst if burst is not None else rate
+            if self.rate is not None:
+                self.tokens = min(self.tokens, self.burst)
+        finally:
+            self.lock.release()
+
+    def refill(self):
+        """Caller must hold self.lock."""
+        now = time()
+        if self.rate is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self, amount):
+        if self.rate is None:
+            return
+        self.lock.acquire(True)
+        try:
+            self.refill()
+            if self.rate is None:   # lifted while we were waiting for the lock
+                return
+            self.tokens -= amount
+            wait = -self.tokens / float(self.rate) if self.tokens < 0 else 0
+        finally:
+            self.lock.release()
+        if wait > 0:
+            sleep(wait)
+
+class RetryPolicy(object):
+    """
+    Decides whether a failed request is worth trying again, and how long to wait first.
+
+    Connection errors (response None) and statuses 408, 429 and 5xx are retried; anything else
+    is the server telling us no, and retrying won't change its mind. An upload gets max_retries
+    tries in a row; any progress resets the count. The delay doubles from base_delay up to
+    max_delay, and a random part of up to jitter of it is taken off, so a burst of failures
+    doesn't come back as a burst of retries.
+    """
+
+    retryable_statuses = frozenset([408, 429])
+
+    def __init__(self, max_retries=5, base_delay=0.5, max_delay=60.0, jitter=0.5):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+    def is_retryable(self, response):
+        return response is None or response.status in self.retryable_statuses or 500 <= response.status < 600
+
+    def should_retry(self, retries, response):
+        """retries is how many times in a row this upload has already been retried."""
+        return retries < self.max_retries and self.is_retryable(response)
+
+    def delay(self, retries):
+        delay = min(self.max_delay, self.base_delay * 2 ** retries)
+        return delay * (1 - self.jitter * random())
+
+class FixedChunkSize(object):
+    """
+    Chunk size policy that never changes chunk_size. This is the default.
+
+    A chunk size policy is anything with these two methods. UploadableFile calls them
+    between chunks and uses whatever they return as its new chunk_size.
+    """
+
+    def chunk_sent(self, chunk_size, bytes_sent, elapsed):
+        """A chunk of bytes_sent bytes took elapsed seconds, request to response."""
+        return chunk_size
+
+    def chunk_failed(self, chunk_size):
+        """A chunk was rejected or lost."""
+        return chunk_size
+
+class AdaptiveChunkSize(FixedChunkSize):
+    """
+    Size each chunk so it takes roughly target_seconds at the throughput the last chunk got.
+    Fast links get fewer, bigger round trips; a failed chunk halves the size so lossy links
+    waste less on each retry. Never grows or shrinks by more than max_step per chunk
+    and always stays within min_size..max_size.
+    """
+
+    def __init__(self, min_size=1024*16, max_size=1024*1024*8, target_seconds=1.0, max_step=2.0):
+        if not 0 < min_size <= max_size:
+            raise ValueError('need 0 < min_size <= max_size, got %r, %r' % (min_size, max_size))
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_seconds = target_seconds
+        self.max_step = max_step
+
+    def clamp(self, chunk_size):
+        return int(max(self.min_size, min(self.max_size, chunk_size)))
+
+    def chunk_sent(self, chunk_size, bytes_sent, elapsed):
+        if elapsed <= 0 or bytes_sent <= 0:
+            return self.clamp(chunk_size)
+        wanted = bytes_sent / elapsed * self.target_seconds
+        wanted = max(chunk_size / self.max_step, min(chunk_size * self.max_step, wanted))
+        return self.clamp(wanted)
+
+    def chunk_failed(self, chunk_size):
+        return self.clamp(chunk_size / 2)
+
+class GzipCodec(object):
+    """
+    Compresses an upload with gzip, sent with Content-Encoding: gzip. See UploadableFile.
+
+    A codec is anything with a content_encoding, a spool_size and a compressor() method returning
+    a fresh object with zlib's compress(data) and flush() methods. The compressed file is kept in
+    memory up to spool_size bytes and in a temporary file past that.
+    """
+
+    content_encoding = 'gzip'
+    wbits = 16 + zlib.MAX_WBITS     # gzip header and trailer
+
+    def __init__(self, level=6, spool_size=1024*1024):
+        self.level = level
+        self.spool_size = spool_size
+
+    def compressor(self):
+        return zlib.compressobj(self.level, zlib.DEFLATED, self.wbits)
+
+class ZlibCodec(GzipCodec):
+    """
+    The same with the zlib format, which HTTP calls Content-Encoding: deflate.
+    """
+
+    content_encoding = 'deflate'
+    wbits = zlib.MAX_WBITS
 
 class UploadableFile(object):
 
     """
     The default chunk size is just a guess for now.
-    Note: we are just reading a segment the lenght of chunksize directly into memory.
-    If you set chunk_size to really-really big, you might have memory issues.
+    Chunks are streamed to the connection by a ChunkReader, a block at a time,
+    so a really-really big chunk_size doesn't mean a really-really big string.
 
-    Content of what is uploaded is determined in file_handle() below.
+    Content of what is uploaded is determined in chunk_source() below.
     If the content is not None, the it is used as the source of the file's contents.
-    If it is a string, it is turned into a StringIO. Otherwise it is simply treated as a file type object.
+    If it is a string, chunks are memoryview slices of it. Otherwise it is simply treated as a file type object.
+
+    chunk_size_policy decides how chunk_size changes between chunks, see FixedChunkSize
+    and AdaptiveChunkSize.
+
+    With parallel_chunks > 1, up to that many chunks are posted at once, each over its own connection
+    but under the same Session-ID. The nginx upload module accepts segments out of order and replies
+    with everything it has so far, so the union of the Range headers tells us which holes are left.
+
+    Requests go over http_connection if one was given, otherwise over a connection borrowed
+    from connection_pool for the length of one request, otherwise over a connection of our own.
+
+    Files no bigger than simple_upload_threshold bytes skip the resumable protocol entirely
+    and go up in one plain POST (no Session-ID or X-Content-Range), expecting a 200.
+    None, the default, always uses the resumable protocol.
+
+    Given a compression codec, such as GzipCodec(), the whole file is compressed into a spooled
+    temporary file before the first chunk and that is what gets uploaded, with Content-Encoding set.
+    With file_handles, that temporary file takes a place in its budget like any open file, and if
+    it is closed to make room, the file is compressed again, to the same bytes, for the next chunk.
+    Byte ranges, total_file_size and progress are all of the compressed bytes, so the resumable
+    protocol works as usual. Files whose type says they are compressed already (see is_compressible)
+    are sent as they are.
+
+    on_progress(upload_id, bytes_confirmed, total_bytes) and on_chunk(upload_id, (first, last), seconds)
+    are called right away, or through callbacks, a CallbackDispatcher, if the file has one.
+
+    A redirect is followed by sending the same request to its Location on the next turn, with the
+    same Session-ID, up to max_redirects in a row. Permanent ones are put in redirect_cache, if any.
+
+    destination_url may be a DestinationGroup, in which case the upload is given one of its hosts by
+    choose_destination, with additional_data folded into that host's URL, and tells the group how
+    every request went so it can fail over if the host goes down.
+
+    There can be a great many of these queued, so they have __slots__ rather than a __dict__,
+    share their chunk_size_policy unless given one, and leave file_lock and parallel_connections
+    until the upload starts. Subclasses get a __dict__ again unless they declare __slots__ too.
 
     """
-    # TODO: Have a boundary size (probably related to chunk size in some way) and do a simple post for smaller files?
+
+    __slots__ = ('_session_id', '_total_file_size', '_file_handle', '_content_view', '_file_lock',
+                 '_http_connection', '_destination_filename', '_file_type',
+                 'file_name', 'destination_url', 'destination_group', 'destination_host', 'additional_data',
+                 'content', 'compression', 'file_handles', 'connection_pool', 'redirect_cache', 'redirects',
+                 'parallel_chunks', 'parallel_connections', 'chunk_size', 'chunk_size_policy',
+                 'simple_upload_threshold', 'retry_policy', 'retries', 'retry_at',
+                 'on_complete', 'on_progress', 'on_chunk', 'upload_id', 'callbacks', 'metrics',
+                 'throttles', 'rate_limit', 'bytes_posted', 'next_byte_to_upload', 'received_ranges', 'response')
+
+    default_chunk_size_policy = FixedChunkSize()
+
+    redirect_statuses = (301, 302, 307, 308)
+    permanent_redirect_statuses = (301, 308)
+    max_redirects = 5
 
     def __init__(self,
                  file_name,
@@ -218,40 +2008,209 @@ class UploadableFile(object):
                  file_type=None,
                  chunk_size=None,
                  on_complete=None,
-                 content=None
+                 content=None,
+                 parallel_chunks=1,
+                 chunk_size_policy=None,
+                 simple_upload_threshold=None,
+                 connection_pool=None,
+                 session_id=None,
+                 received_ranges=None,
+                 retry_policy=None,
+                 on_progress=None,
+                 on_chunk=None,
+                 compression=None
             ):
-        self._session_id = None
-        self._content_length = None
+        self._session_id = session_id
         self._total_file_size = None
         self._file_handle = None
+        self._content_view = None
+        self._file_lock = None
+        self.file_handles = None        # FileHandleCache to borrow file_handle from, if any
+        self.bytes_posted = 0           # request body bytes sent, retries and all
+        self.throttles = []             # TokenBuckets every chunk is sent through
+        self.rate_limit = None          # this upload's own TokenBucket, if it has one
+        self.metrics = None             # the UploadMetrics to count requests in, if any
+        self.redirect_cache = None      # the RedirectCache to remember permanent redirects in, if any
+        self.redirects = 0              # redirects followed in a row
         self.next_byte_to_upload = 0
         self.file_name = file_name
         self._http_connection = http_connection
+        self.connection_pool = connection_pool
         self._destination_filename = destination_filename
         self._file_type = file_type
         self.chunk_size = chunk_size if chunk_size is not None else 1024*50
+        self.chunk_size_policy = chunk_size_policy if chunk_size_policy is not None else self.default_chunk_size_policy
+        self.simple_upload_threshold = simple_upload_threshold
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self.retries = 0        # failed attempts in a row
+        self.retry_at = 0       # don't post again before this time()
         self.on_complete = on_complete
+        self.on_progress = on_progress
+        self.on_chunk = on_chunk
+        self.upload_id = None           # what on_progress and on_chunk are told this upload is called
+        self.callbacks = None           # the CallbackDispatcher they are called through, if any
         self.content = content
+        self.compression = compression
         self.response = None
-        if isinstance(destination_url, ParseResult):
+        if parallel_chunks < 1:
+            raise ValueError('parallel_chunks must be at least 1, got %r' % parallel_chunks)
+        self.parallel_chunks = parallel_chunks
+        self.parallel_connections = None    # connections of our own for parallel chunks, made when needed
+        self.received_ranges = received_ranges or []    # inclusive (first, last) tuples the server has confirmed
+        if self.received_ranges and 0 == self.received_ranges[0][0]:
+            self.next_byte_to_upload = self.received_ranges[0][1] + 1
+        self.destination_group = None
+        self.destination_host = None        # index of the destination_group URL this upload was given
+        self.additional_data = None         # kept only to fold into that URL
+        if isinstance(destination_url, DestinationGroup):
+            self.destination_group = destination_url
+            self.additional_data = additional_data
+            self.destination_url = None     # until choose_destination
+        elif isinstance(destination_url, ParseResult):
             self.destination_url = destination_url
         else:
             self.destination_url = urlparse(destination_url)
-        if additional_data:
+        if additional_data and self.destination_url is not None:
             self.destination_url = fold_additional_data(self.destination_url, additional_data)
 
+    def choose_destination(self, key, exclude=None):
+        """
+        Take a host from destination_group for this upload, hashing key for 'consistent_hash'.
+        """
+        try:
+            size = len(self.content) if isinstance(self.content, str) else stat(self.file_name).st_size
+        except (TypeError, OSError):    # a file object, or a file that isn't there yet
+            size = 0
+        self.destination_host = self.destination_group.assign(self, key, size, exclude)
+        self.destination_url = fold_additional_data(self.destination_group.urls[self.destination_host],
+                                                    self.additional_data)
+
+    def fail_over(self):
+        """
+        Move to another host of destination_group, since ours is down. The server keeps a session's
+        bytes on the host that got them, so if any were sent the upload starts over under a new session.
+        """
+        previous = self.destination_url
+        self.choose_destination(self.upload_id if self.upload_id is not None else self.file_name,
+                                exclude=self.destination_host)
+        if self.destination_url == previous:
+            return
+        warning('%s is down, sending %s to %s instead.', previous.netloc, self.destination_filename,
+                self.destination_url.netloc)
+        if self.received_ranges or self.bytes_posted:
+            self._session_id = None
+            self.received_ranges = []
+            self.next_byte_to_upload = 0
+        self.close_connections()
+
+    def close_connections(self):
+        """
+        Close the connections of our own, which are to the old host after fail_over or a redirect.
+        """
+        if self.parallel_connections:
+            for connection in self.parallel_connections:
+                connection.close()
+            self.parallel_connections = None
+        if self._http_connection is not None:
+            self._http_connection.close()
+            self._http_connection = None
+
+    @property
+    def file_lock(self):
+        """
+        Serializes seek and read of file_handle for parallel chunks. Made by the worker before
+        it starts any threads for them, so there's no race to make it.
+        """
+        if self._file_lock is None:
+            self._file_lock = Lock()
+        return self._file_lock
+
     @property
     def http_connection(self):
         if self._http_connection is None:
-            self._http_connection = HTTPConnection(self.destination_url.netloc)
+            self._http_connection = self.new_http_connection()
         return self._http_connection
 
+    def new_http_connection(self):
+        return new_connection(self.destination_url)
+
+    @property
+    def uses_pool(self):
+        return self._http_connection is None and self.connection_pool is not None
+
+    def acquire_connection(self, block=True):
+        if self.uses_pool:
+            return self.connection_pool.acquire(self.destination_url, block)
+        return self.http_connection
+
+    def release_connection(self, connection):
+        if self.uses_pool:
+            self.connection_pool.release(self.destination_url, connection)
+
+    def send_request(self, connection, body, headers):
+        """
+        POST body over connection and read the whole response, so the connection can be used again.
+        A kept-alive connection the server has quietly closed fails on first use; in that case
+        the connection is reopened and the request sent once more.
+        """
+        for attempt in (1, 2):
+            try:
+                started = time()
+                connection.request('POST', self.uri, body, headers)
+                response = connection.getresponse()
+                response_body = response.read()     # drained whether or not anyone logs it
+                elapsed = time() - started
+                debug('Got response: %s', response_body)
+                self.file_lock.acquire(True)
+                try:
+                    self.bytes_posted += len(body)
+                finally:
+                    self.file_lock.release()
+                if self.metrics is not None:
+                    self.metrics.chunk_sent(len(body), elapsed)
+                if self.destination_group is not None:
+                    if response.status >= 500:
+                        self.destination_group.failed(self.destination_host)
+                    else:
+                        self.destination_group.succeeded(self.destination_host)
+                self.notify('chunk', self.on_chunk, (body.first, body.last), elapsed)
+                return response
+            except (socket.error, HTTPException):
+                if attempt > 1:
+                    if self.destination_group is not None:
+                        self.destination_group.failed(self.destination_host)
+                    raise
+                warning('Connection to %s broke, reconnecting.', self.destination_url.netloc)
+                connection.close()          # httplib reconnects on the next request
+                body.rewind()
+
+    def notify(self, kind, callback, *args):
+        if callback is None:
+            return
+        if self.callbacks is not None:
+            self.callbacks.post((self.upload_id, kind), callback, self.upload_id, *args)
+        else:
+            callback(self.upload_id, *args)
+
+    def post(self, body, headers, connection=None):
+        """
+        send_request over connection, or over one from acquire_connection that is released afterwards.
+        """
+        if connection is not None:
+            return self.send_request(connection, body, headers)
+        connection = self.acquire_connection()
+        try:
+            return self.send_request(connection, body, headers)
+        finally:
+            self.release_connection(connection)
+
     @property
     def session_id(self):
         """
         It appears that this must be numeric. Reference implementation does:
         Math.round(Math.random() * 100000000);
-        So clearly, not resumable across multiple sessions, unless we persist session_id to disk...
+        So clearly, not resumable across multiple sessions, unless we persist session_id to disk,
+        which is what UploadJournal does.
         """
         if self._session_id is None:
             self._session_id = randint(0, 100000000)
@@ -264,37 +2223,162 @@ class UploadableFile(object):
             debug('guessing file type: %s', self._file_type)
         return self._file_type
 
+    # Types guess_type gives to files that are compressed already, apart from image/*, audio/* and video/*.
+    compressed_file_types = frozenset([
+        'application/zip', 'application/gzip', 'application/x-gzip', 'application/x-bzip2',
+        'application/x-xz', 'application/x-7z-compressed', 'application/x-rar-compressed',
+        'application/java-archive', 'application/pdf',
+    ])
+
+    @property
+    def is_compressible(self):
+        """False for images, audio, video, archives and anything guess_type says has an encoding like .gz."""
+        if guess_type(self.file_name)[1] is not None:
+            return False
+        major_type = self.file_type.split('/', 1)[0]
+        return major_type not in ('image', 'audio', 'video') and self.file_type not in self.compressed_file_types
+
+    @property
+    def is_compressed(self):
+        """True if what is uploaded is the file compressed with self.compression."""
+        return self.compression is not None and self.is_compressible
+
     @property
     def total_file_size(self):
+        if self._total_file_size is None and isinstance(self.content, str) and not self.is_compressed:
+            self._total_file_size = len(self.content)
+        if self._total_file_size is None and self.content is None and not self.is_compressed:
+            self._total_file_size = stat(self.file_name).st_size
         if self._total_file_size is None:
             self.file_handle.seek(0, SEEK_END)
             self._total_file_size = self.file_handle.tell()
         return self._total_file_size
 
+    @property
+    def next_chunk_bounds(self):
+        """
+        Inclusive (first, last) of the next chunk: chunk_size past next_byte_to_upload,
+        but stopping short of the end of the file or of a segment the server already has.
+        """
+        first = self.next_byte_to_upload
+        if first >= self.total_file_size:
+            return self.final_chunk
+        last = min(first + self.chunk_size, self.total_file_size - 1)
+        for received_first, received_last in self.received_ranges:
+            if received_first > first:
+                last = min(last, received_first - 1)
+                break
+        return first, last
+
+    @property
+    def final_chunk(self):
+        """
+        The last chunk of the file, sent again when the server has every byte yet hasn't replied 200.
+        """
+        return max(0, self.total_file_size - 1 - self.chunk_size), self.total_file_size - 1
+
     @property
     def next_content_range(self):
-        plus_chunk = self.next_byte_to_upload + self.chunk_size
-        top_bound = plus_chunk if plus_chunk < self.total_file_size else self.total_file_size - 1
-        return 'bytes %d-%d/%d' % (self.next_byte_to_upload, top_bound, self.total_file_size)
+        first, last = self.next_chunk_bounds
+        return 'bytes %d-%d/%d' % (first, last, self.total_file_size)
+
+    @property
+    def uses_file_handles(self):
+        return self.file_handles is not None and (self.content is None or self.is_compressed)
 
     @property
     def file_handle(self):
-        if self._file_handle is None:
-            if self.content is None:
-                self._file_handle = open(self.file_name, 'rb')
-            else:
-                self._file_handle = self.content        # assume it's a file handle / StringIO
-                try:
-                    self.content.seek(0)
-                except AttributeError:                  # assume it's a string
-                    self._file_handle = StringIO(self.content)
+        if self._file_handle is None and self.uses_file_handles:
+            opener = UploadableFile.open_compressed if self.is_compressed else None
+            self._file_handle = self.file_handles.open(self, opener)
+        elif self._file_handle is None:
+            self._file_handle = self.open_compressed() if self.is_compressed else self.open_content()
         return self._file_handle
 
+    def release_file_handle(self):
+        """
+        Hand file_handle back to file_handles between chunks, so it can be closed if need be.
+        """
+        if self._file_handle is not None and self.uses_file_handles:
+            self.file_handles.release(self)
+            self._file_handle = None
+
+    def close(self):
+        """
+        Done with the file for good, whether the upload finished, failed or was canceled.
+        """
+        if self.uses_file_handles:
+            self.file_handles.discard(self)
+        elif self._file_handle is not None:
+            self._file_handle.close()
+        self._file_handle = None
+        if self.destination_group is not None:
+            self.destination_group.release(self)
+
+    def open_content(self):
+        if self.content is None:
+            return open(self.file_name, 'rb')
+        try:
+            self.content.seek(0)                # assume it's a file handle / StringIO
+            return self.content
+        except AttributeError:                  # assume it's a string
+            return StringIO(self.content)
+
+    def open_compressed(self):
+        content = self.open_content()
+        try:
+            return self.compress(content)
+        finally:
+            if self.content is None:
+                content.close()
+
+    def compress(self, content):
+        """
+        content compressed with self.compression, streamed a block at a time into a SpooledTemporaryFile.
+        """
+        compressor = self.compression.compressor()
+        compressed = SpooledTemporaryFile(self.compression.spool_size)
+        for block in iter(lambda: content.read(64 * 1024), ''):
+            compressed.write(compressor.compress(block))
+        compressed.write(compressor.flush())
+        debug('Compressed %s to %d bytes with %s', self.file_name, compressed.tell(), self.compression.content_encoding)
+        return compressed
+
+    @property
+    def chunk_source(self):
+        """
+        A memoryview of string content, so chunks are slices rather than copies. Otherwise file_handle.
+        """
+        if isinstance(self.content, str) and not self.is_compressed:
+            if self._content_view is None:
+                self._content_view = memoryview(self.content)
+            return self._content_view
+        return self.file_handle
+
     @property
     def next_chunk(self):
-        self.file_handle.seek(self.next_byte_to_upload) # upload starting from the next byte
-        chunk = self.file_handle.read(self.chunk_size + 1)
-        return chunk
+        return self.read_chunk(*self.next_chunk_bounds)
+
+    def read_chunk(self, first, last):
+        return ChunkReader(self.chunk_source, first, last, self.file_lock, self.throttles)
+
+    def planned_chunks(self, count):
+        """
+        Up to count inclusive (first, last) byte ranges, each at most chunk_size + 1 bytes long
+        (same as next_content_range), that fill the holes between received_ranges.
+        """
+        chunks = []
+        first = 0
+        end_of_file = (self.total_file_size, self.total_file_size)
+        for received_first, received_last in self.received_ranges + [end_of_file]:
+            while first < received_first and len(chunks) < count:
+                last = min(first + self.chunk_size, received_first - 1)
+                chunks.append((first, last))
+                first = last + 1
+            if len(chunks) >= count:
+                break
+            first = max(first, received_last + 1)
+        return chunks
 
     @property
     def destination_filename(self):
@@ -304,48 +2388,293 @@ class UploadableFile(object):
             self._destination_filename = tail
         return self._destination_filename
 
+    @property
+    def destination(self):
+        """Where this is going, for log messages: the URL, or the DestinationGroup until it is given a host."""
+        if self.destination_url is None:
+            return repr(self.destination_group)
+        return urlunparse(self.destination_url)
+
     @property
     def uri(self):
         return '%s?%s' % (self.destination_url.path, self.destination_url.query)
 
-    def post_next_chunk(self):
-        range = self.next_content_range
+    def simple_headers(self):
         headers = {
             'Content-Disposition': 'attachment; filename="%s"' % quote_plus(self.destination_filename),
             'Content-Type': self.file_type,
-            'X-Content-Range': range,
-            'Session-ID': self.session_id,
         }
+        if self.is_compressed:
+            headers['Content-Encoding'] = self.compression.content_encoding
+        return headers
+
+    def chunk_headers(self, range):
+        headers = self.simple_headers()
+        headers['X-Content-Range'] = range
+        headers['Session-ID'] = self.session_id
+        return headers
+
+    @property
+    def is_simple_upload(self):
+        return (self.simple_upload_threshold is not None
+                and self.total_file_size <= self.simple_upload_threshold
+                and 0 == self.next_byte_to_upload
+                and not self.received_ranges)
+
+    def post_whole_file(self):
+        """
+        Send the entire file in a single plain POST. Same return values as post_next_chunk.
+        """
+        debug('Sending %s in one request, %d bytes', self.destination_filename, self.total_file_size)
+        self.response = self.post(self.read_chunk(0, self.total_file_size - 1), self.simple_headers())
+        if 200 == self.response.status:
+            return self.upload_complete()
+        elif self.response.status in self.redirect_statuses:
+            return self.follow_redirect()
+        return self.upload_failed()
+
+    def post_next_chunk(self):
+        """
+        Send the next chunk, or chunks, or the whole file. Returns how many bytes are still to go,
+        0 once the server has the whole file, or -1 if the upload failed for good.
+        A failure worth retrying also returns a positive number, with retry_at set to when to try.
+        """
+        if self.destination_url is None:
+            self.choose_destination(self.upload_id if self.upload_id is not None else self.file_name)
+        if self.redirect_cache is not None and not self.bytes_posted:
+            # Looked up as late as possible, so uploads queued before a redirect was seen benefit too.
+            self.destination_url = self.redirect_cache.resolve(self.destination_url)
+        try:
+            if self.is_simple_upload:
+                return self.post_whole_file()
+            if self.parallel_chunks > 1:
+                return self.post_parallel_chunks()
+            return self.post_single_chunk()
+        except (socket.error, HTTPException) as e:
+            warning('Sending %s to %s failed: %r', self.destination_filename, self.destination_url.netloc, e)
+            self.response = None
+            return self.upload_failed()
+        finally:
+            self.release_file_handle()
+
+    def post_single_chunk(self):
+        first, last = self.next_chunk_bounds
+        range = self.next_content_range
+        headers = self.chunk_headers(range)
 
         debug('Sending %s %s', self.destination_filename, range)
-        self.http_connection.request('POST', self.uri, self.next_chunk, headers)
-        self.response = self.http_connection.getresponse()
-        debug('Got response: %s', self.response.read())
+        started = time()
+        self.response = self.post(self.next_chunk, headers)
+        if self.response.status in (200, 201):
+            self.adapt_chunk_size(last - first + 1, time() - started)
         if 201 == self.response.status:
-            # Not done yet, figure out the next lowest bound in the series and set next_byte_to_upload.
+            # Not done yet, figure out the first hole in what the server has and set next_byte_to_upload.
+            # The reply is what the server has now, which may be less than it told us before.
             received_range = self.response.getheader('Range')
-            m = RECEIVED_RANGE_PATTERN.match(received_range)
-            if m is None:
+            received = parse_received_ranges(received_range)
+            if not received:
                 debug('Starting at byte 0, since odd received range: %s', received_range)
-                self.next_byte_to_upload = 0
-            else:
-                self.next_byte_to_upload = int(m.group('next_byte_to_upload'))
-                debug('Advancing next_byte_to_upload to %d', self.next_byte_to_upload)
-            return self.total_file_size - self.next_byte_to_upload
+            self.received_ranges = merge_ranges(sorted(received))
+            return self.advance_to_first_hole()
         elif 200 == self.response.status:            # yay! we're done!!!
-            self._file_handle.close()
-            self.next_byte_to_upload = self.total_file_size
-            if self.on_complete:
-                self.on_complete(response=self.response)
-            return 0
-        # TODO: add redirection support?
-#        elif self.response.status in (301, 307): # perm/temp redir
-#            new_url = self.response.headers['Location']
+            return self.upload_complete()
+        elif self.response.status in self.redirect_statuses:
+            return self.follow_redirect()
         else:
-            warning('I got an unexpected return status: %d %s', self.response.status, self.response.reason)
-            if self.on_complete:
+            return self.upload_failed()
+
+    def follow_redirect(self):
+        """
+        Point destination_url at the Location self.response redirected us to, remembering it in
+        redirect_cache if it's permanent, and return the bytes still to go, with retry_at set so
+        they go there right away. Fails the upload if there's no usable Location, or too many redirects.
+        """
+        location = self.response.getheader('Location')
+        target = urlparse(urljoin(urlunparse(self.destination_url), location)) if location else None
+        if target is None or target.scheme.lower() not in ('http', 'https'):
+            warning('Can not follow redirect of %s to %r', self.destination_filename, location)
+            return self.upload_failed()
+        if not target.query:
+            target = target._replace(query=self.destination_url.query)
+        if self.redirects >= self.max_redirects:
+            warning('Giving up on %s after %d redirects in a row', self.destination_filename, self.redirects)
+            return self.upload_failed()
+        info('%s redirected from %s to %s (%d)', self.destination_filename, urlunparse(self.destination_url),
+             urlunparse(target), self.response.status)
+        if self.response.status in self.permanent_redirect_statuses and self.redirect_cache is not None:
+            self.redirect_cache.put(self.destination_url, target)
+        if target.netloc.lower() != self.destination_url.netloc.lower():
+            self.close_connections()
+        self.destination_url = target
+        self.redirects += 1
+        self.retry_at = 0
+        return self.bytes_to_go
+
+    def adapt_chunk_size(self, bytes_sent, elapsed):
+        chunk_size = self.chunk_size_policy.chunk_sent(self.chunk_size, bytes_sent, elapsed)
+        if chunk_size != self.chunk_size:
+            debug('Chunk size for %s going from %d to %d (%d bytes in %.3fs)',
+                  self.destination_filename, self.chunk_size, chunk_size, bytes_sent, elapsed)
+            self.chunk_size = chunk_size
+
+    def call_on_complete(self):
+        """
+        on_complete(response=self.response), if there is one. Whatever it raises is logged and
+        ignored, so a broken callback can't turn a finished upload into a failed one.
+        """
+        if self.on_complete:
+            try:
                 self.on_complete(response=self.response)
-            return -1
+            except Exception:
+                warning('on_complete of %s raised an exception, ignoring it.', self.file_name, exc_info=True)
+
+    def upload_complete(self):
+        self.retries = 0
+        self.redirects = 0
+        self.close()
+        self.next_byte_to_upload = self.total_file_size
+        self.notify('progress', self.on_progress, *self.progress)
+        self.call_on_complete()
+        return 0
+
+    def upload_failed(self):
+        """
+        Either schedule a retry at retry_at and return the bytes still to go, or give up:
+        call on_complete with the failed response (None after a connection error) and return -1.
+        """
+        self.chunk_size = self.chunk_size_policy.chunk_failed(self.chunk_size)
+        if self.response is not None:
+            warning('I got an unexpected return status: %d %s', self.response.status, self.response.reason)
+        if self.retry_policy.should_retry(self.retries, self.response):
+            delay = self.retry_policy.delay(self.retries)
+            if self.destination_group is not None and self.destination_group.is_down(self.destination_host):
+                self.fail_over()
+                delay = 0           # no need to wait for a host we haven't tried
+            self.retries += 1
+            self.retry_at = time() + delay
+            info('Retrying %s in %.2fs, attempt %d', self.destination_filename, delay, self.retries)
+            if self.metrics is not None:
+                self.metrics.retried()
+            return self.bytes_to_go
+        self.close()
+        self.call_on_complete()
+        return -1
+
+    @property
+    def bytes_to_go(self):
+        """Bytes the server hasn't confirmed. Never 0, even for an empty file, since 0 means done."""
+        return max(1, self.total_file_size - sum(last - first + 1 for first, last in self.received_ranges))
+
+    def post_parallel_chunks(self):
+        """
+        Post up to parallel_chunks chunks at once, one per connection, and set received_ranges to the
+        union of the Range headers of their replies. Same return values as post_next_chunk.
+        """
+        chunks = self.planned_chunks(self.parallel_chunks) or [self.final_chunk]
+        # The file before the connections, the same order as post_single_chunk, or an upload holding
+        # connections could wait on file_handles while one holding a file waits on the pool.
+        bodies = [self.read_chunk(first, last) for first, last in chunks]
+        connections = [self.acquire_connection()]
+        if self.uses_pool:
+            # Only take connections that are free right now, so files can't deadlock each other.
+            while len(connections) < len(chunks):
+                connection = self.connection_pool.acquire(self.destination_url, block=False)
+                if connection is None:
+                    break
+                connections.append(connection)
+            chunks = chunks[:len(connections)]
+            bodies = bodies[:len(connections)]
+        else:
+            if self.parallel_connections is None:
+                self.parallel_connections = []
+            while len(self.parallel_connections) < len(chunks) - 1:
+                self.parallel_connections.append(self.new_http_connection())
+            connections += self.parallel_connections
+        responses = [None] * len(chunks)
+        errors = []
+        started = time()
+
+        def send(i):
+            first, last = chunks[i]
+            range = 'bytes %d-%d/%d' % (first, last, self.total_file_size)
+            debug('Sending %s %s', self.destination_filename, range)
+            try:
+                responses[i] = self.send_request(connections[i], bodies[i], self.chunk_headers(range))
+            except Exception:
+                errors.append(sys.exc_info())
+
+        threads = [Thread(target=send, args=(i,)) for i in range(1, len(chunks))]
+        try:
+            for t in threads:
+                t.start()
+            send(0)
+            for t in threads:
+                t.join()
+        finally:
+            for connection in connections:
+                self.release_connection(connection)
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+        if all(response.status in (200, 201) for response in responses):
+            # Chunks went out side by side, so this is the throughput of one connection.
+            self.adapt_chunk_size(sum(last - first + 1 for first, last in chunks) / len(chunks), time() - started)
+
+        for response in responses:
+            self.response = response
+            if 200 == response.status:
+                return self.upload_complete()
+        for response in responses:
+            self.response = response
+            if response.status in self.redirect_statuses:
+                return self.follow_redirect()
+        received = []
+        for response in responses:
+            self.response = response
+            if 201 != response.status:
+                return self.upload_failed()
+            received += parse_received_ranges(response.getheader('Range'))
+        # Each reply saw the server at some point during this round; earlier rounds are out of date.
+        self.received_ranges = merge_ranges(sorted(received))
+        return self.advance_to_first_hole()
+
+    def advance_to_first_hole(self):
+        """
+        Point next_byte_to_upload at the first byte the server doesn't have.
+        Returns how many bytes are still missing.
+
+        Only a 200 means the upload is done. If the server says it has every byte but didn't
+        say that, next_byte_to_upload is left at the end of the file, so final_chunk is sent
+        again to get one. That counts as a retry; once retries run out, the upload fails.
+        """
+        holes = self.planned_chunks(1)
+        if not holes:
+            warning('Server has every byte of %s but never said it was done, sending the end again.',
+                    self.destination_filename)
+            if self.retries >= self.retry_policy.max_retries:
+                return self.upload_failed()
+            self.retries += 1
+            if self.metrics is not None:
+                self.metrics.retried()
+        else:
+            self.retries = 0
+        self.redirects = 0
+        self.next_byte_to_upload = holes[0][0] if holes else self.total_file_size
+        debug('Received ranges for %s are %s, advancing next_byte_to_upload to %d',
+              self.destination_filename, self.received_ranges, self.next_byte_to_upload)
+        self.notify('progress', self.on_progress, *self.progress)
+        return self.bytes_to_go
+
+    @property
+    def progress(self):
+        """
+        (bytes the server has confirmed, total_file_size). The total is None for a file
+        that hasn't been opened yet; progress doesn't go opening files just to be looked at.
+        """
+        confirmed = sum(last - first + 1 for first, last in self.received_ranges)
+        total = self._total_file_size
+        if total is None and isinstance(self.content, str):
+            total = len(self.content)
+        return max(confirmed, self.next_byte_to_upload), total
 
     @property
     def is_done(self):
@@ -363,6 +2692,12 @@ if __name__ == '__main__':
     parser = OptionParser(usage=usage, version=__vcs_id__)
     parser.add_option('-q', '--quiet', dest='quiet_count', action='count')
     parser.add_option('-v', '--verbose', dest='verbose_count', action='count')
+    parser.add_option('-j', '--journal', dest='journal', metavar='FILE',
+                      help='remember uploads in FILE and resume unfinished ones from it')
+    parser.add_option('-r', '--rate-limit', dest='rate_limit', type='int', metavar='BYTES',
+                      help='upload at most BYTES per second')
+    parser.add_option('-z', '--gzip', dest='gzip', action='store_true', default=False,
+                      help='gzip files on the fly, unless they are compressed already')
     (options, arguments) = parser.parse_args()
 
     console = StreamHandler()
@@ -381,29 +2716,40 @@ if __name__ == '__main__':
     elif raw_log_level == 3: l.setLevel(INFO)
     else:                    l.setLevel(DEBUG)
 
+    # connections are re-used through theLightweightUploader.connection_pool rather than made per file
+    upload_url = arguments.pop(0)
+    new_connection(urlparse(upload_url)).close()    # complain about a bad scheme now, not in the thread
+
+    def notifier(file_name):
+        def notify(response):
+            if response is None:
+                warning('%s: gave up, could not reach the server', file_name)
+            else:
+                info('%s: %d %s', file_name, response.status, response.reason)
+        return notify
+
+    resumed = set()     # (file_name, destination_url) of the uploads the journal had
+    if options.journal is not None:
+        theLightweightUploader.journal = UploadJournal(options.journal)
+        for id in theLightweightUploader.replay_journal():
+            file = theLightweightUploader.uploads[id].file
+            file.on_complete = notifier(file.file_name)
+            resumed.add((file.file_name, urlunparse(file.destination_url)))
+    if options.rate_limit is not None:
+        theLightweightUploader.set_rate_limit(options.rate_limit)
+
     debug('Starting theLightweightUploader thread')
     theLightweightUploader.start()
 
-    # re-use the HTTPConnection rather than making a new one per file
-    upload_url = arguments.pop(0)
-    url = urlparse(upload_url)
-    scheme = url.scheme.lower()
-    if 'http' == scheme:
-        connection = HTTPConnection(url.netloc)
-    elif 'https' == scheme:
-        connection = HTTPSConnection(url.netloc)
-    else:
-        raise ValueError("I only know how to upload via either http https")
-
     for f in arguments:
-        def notify(response):
-            info('%s: %d %s', f, response.status, response.reason)
+        if (f, urlunparse(urlparse(upload_url))) in resumed:
+            info('%s: resuming the upload the journal had', f)
+            continue
         theLightweightUploader.enqueue_upload(
             f,
             upload_url,
-            http_connection=connection,
-            on_complete=notify)
+            on_complete=notifier(f),
+            compression=GzipCodec() if options.gzip else None)
 
     # wait for all files to be uploaded.
-    while not theLightweightUploader.is_done:
-        sleep(0.1)
+    theLightweightUploader.wait_all()
@@ -6,13 +6,22 @@ And unittest2 (which is pretty standard these days, seems to me)
 """
 
 from cStringIO import StringIO
-from httplib import HTTPConnection, HTTPResponse
+from httplib import HTTPConnection, HTTPSConnection, HTTPResponse
 from logging import debug, info, warning, critical
-from urlparse import ParseResult
-from mock import Mock, MagicMock
+from urlparse import ParseResult, urlparse, urlunparse
+from mock import Mock, MagicMock, patch
 from patched_unittest2 import *
 from random import randint
+from os.path import join
+from shutil import rmtree
+import socket
+from tempfile import mkdtemp
+from threading import Event
+from time import sleep, time
+import unittest2
+import zlib
 
+import bench_py_lightweight_uploader
 import py_lightweight_uploader
 
 class TestUploadableFile(PatchedTestCase): pass
@@ -21,13 +30,14 @@ class TestUploadableFile(PatchedTestCase): pass
 @TestUploadableFile.patch('py_lightweight_uploader.warning', spec=warning)
 @TestUploadableFile.patch('py_lightweight_uploader.critical', spec=critical)
 @TestUploadableFile.patch('py_lightweight_uploader.open', create=True)
+@TestUploadableFile.patch('py_lightweight_uploader.stat')
 @TestUploadableFile.patch('py_lightweight_uploader.randint', spec=randint)
 class TestUploadableFile(PatchedTestCase):
 
     def postSetUpPreRun(self):
         self.mock_randint.return_value = 6543217
         self.mock_open.return_value = MagicMock(spec=file)
-        self.mock_open.return_value.tell.return_value = 123456
+        self.mock_stat.return_value.st_size = 123456
         self.mock_http_connection = Mock(spec=HTTPConnection)
         self.mock_response = Mock(spec=HTTPResponse)
         self.mock_http_connection.getresponse.return_value = self.mock_response
@@ -60,7 +70,7 @@ class TestUploadableFile(PatchedTestCase):
 
         self.target.post_next_chunk()
 
-        self.assertEquals(51200, self.target.next_byte_to_upload)
+        self.assertEquals(51201, self.target.next_byte_to_upload)
 
         self.mock_open.assert_called_once_with('/path/to/fake_file_name.txt', 'rb')
 
@@ -93,7 +103,7 @@ class TestUploadableFile(PatchedTestCase):
         self.mock_response.status = 201
         self.mock_response.getheader.return_value = '0-61200/123456'
         self.target.post_next_chunk()
-        self.assertEquals(61200, self.target.next_byte_to_upload)
+        self.assertEquals(61201, self.target.next_byte_to_upload)
 
         self.mock_open.assert_called_once_with('/path/to/fake_file_name.txt', 'rb')
 
@@ -212,7 +222,7 @@ class TestUploadableFile(PatchedTestCase):
         self.mock_response.getheader.return_value = '0-%d/%d' % (fake_content_length - 1, fake_content_length)
         self.target.post_next_chunk()
 
-        self.assertEquals(fake_content_length - 1, self.target.next_byte_to_upload)
+        self.assertEquals(fake_content_length, self.target.next_byte_to_upload)
 
         self.assertEquals(False, self.mock_open.called)
 
@@ -247,7 +257,7 @@ class TestUploadableFile(PatchedTestCase):
         self.mock_response.getheader.return_value = '0-%d/%d' % (fake_content_length - 1, fake_content_length)
         self.target.post_next_chunk()
 
-        self.assertEquals(fake_content_length - 1, self.target.next_byte_to_upload)
+        self.assertEquals(fake_content_length, self.target.next_byte_to_upload)
 
         self.assertEquals(False, self.mock_open.called)
 
@@ -267,6 +277,903 @@ class TestUploadableFile(PatchedTestCase):
         self.assertEquals((), m[1][1])
         self.assertEquals({}, m[1][2])
 
+    def test_post_next_chunk_skips_segments_already_received(self):
+        self.target = py_lightweight_uploader.UploadableFile(
+            '/path/to/fake_file_name.txt',
+            'http://fake.destination/url?a=b&c=d',
+            self.mock_http_connection,
+        )
+        self.mock_response.status = 201
+        self.mock_response.getheader.return_value = '0-99,200-299/123456'
+        remaining = self.target.post_next_chunk()
+        self.assertEquals([(0, 99), (200, 299)], self.target.received_ranges)
+        self.assertEquals(100, self.target.next_byte_to_upload)
+        self.assertEquals(123456 - 200, remaining)
+        self.assertEquals('bytes 100-199/123456', self.target.next_content_range)
+
+    def test_post_next_chunk_range_not_starting_at_zero(self):
+        self.target = py_lightweight_uploader.UploadableFile(
+            '/path/to/fake_file_name.txt',
+            'http://fake.destination/url?a=b&c=d',
+            self.mock_http_connection,
+        )
+        self.target.next_byte_to_upload = 500
+        self.mock_response.status = 201
+        self.mock_response.getheader.return_value = '500-1000/123456'
+        self.target.post_next_chunk()
+        self.assertEquals(0, self.target.next_byte_to_upload)
+        self.assertEquals('bytes 0-499/123456', self.target.next_content_range)
+
+    def test_string_content_is_sent_as_memoryview_slices(self):
+        self.target = py_lightweight_uploader.UploadableFile(
+            '/path/to/fake_file_name.txt',
+            'http://fake.destination/url?a=b&c=d',
+            self.mock_http_connection,
+            chunk_size=4,
+            content='fake file contents'
+        )
+        self.target.next_byte_to_upload = 5
+        self.mock_response.status = 201
+        self.mock_response.getheader.return_value = '0-9/18'
+        self.target.post_next_chunk()
+
+        body = self.mock_http_connection.request.call_args[0][2]
+        self.assertEquals(5, len(body))
+        block = body.read(3)
+        self.assertTrue(isinstance(block, memoryview))
+        self.assertEquals('fil', block.tobytes())
+        self.assertEquals('e ', body.read().tobytes())
+        self.assertEquals('', body.read())
+        self.assertEquals(False, self.mock_open.called)
+
+    def test_simple_upload_below_threshold(self):
+        mock_on_complete = Mock()
+        self.target = py_lightweight_uploader.UploadableFile(
+            '/path/to/fake_file_name.txt',
+            'http://fake.destination/url?a=b&c=d',
+            self.mock_http_connection,
+            on_complete=mock_on_complete,
+            simple_upload_threshold=123456
+        )
+        self.mock_response.status = 200
+        self.assertEquals(0, self.target.post_next_chunk())
+        self.assertTrue(self.target.is_done)
+        mock_on_complete.assert_called_once_with(response=self.mock_response)
+
+        m = self.mock_http_connection.method_calls
+        self.assertEquals('POST', m[0][1][0])
+        self.assertEquals('/url?a=b&c=d', m[0][1][1])
+        self.assertEquals(123456, len(m[0][1][2]))
+        self.assertEquals({'Content-Disposition': 'attachment; filename="fake_file_name.txt"',
+                           'Content-Type': 'text/plain'}, m[0][1][3])
+
+    def test_chunked_upload_above_threshold(self):
+        self.target = py_lightweight_uploader.UploadableFile(
+            '/path/to/fake_file_name.txt',
+            'http://fake.destination/url?a=b&c=d',
+            self.mock_http_connection,
+            simple_upload_threshold=123455
+        )
+        self.mock_response.status = 201
+        self.mock_response.getheader.return_value = '0-51200/123456'
+        self.target.post_next_chunk()
+        self.assertEquals('bytes 0-51200/123456',
+                          self.mock_http_connection.request.call_args[0][3]['X-Content-Range'])
+
+    def test_reconnects_when_kept_alive_connection_broke(self):
+        self.target = py_lightweight_uploader.UploadableFile(
+            '/path/to/fake_file_name.txt',
+            'http://fake.destination/url?a=b&c=d',
+            self.mock_http_connection,
+        )
+        self.mock_http_connection.request.side_effect = [socket.error(32, 'Broken pipe'), None]
+        self.mock_response.status = 201
+        self.mock_response.getheader.return_value = '0-51200/123456'
+        self.target.post_next_chunk()
+        self.assertEquals(1, self.mock_http_connection.close.call_count)
+        self.assertEquals(2, self.mock_http_connection.request.call_count)
+        self.assertEquals(51201, self.target.next_byte_to_upload)
+
+    def test_retryable_status_schedules_retry(self):
+        mock_on_complete = Mock()
+        self.target = py_lightweight_uploader.UploadableFile(
+            '/path/to/fake_file_name.txt',
+            'http://fake.destination/url?a=b&c=d',
+            self.mock_http_connection,
+            on_complete=mock_on_complete,
+            retry_policy=py_lightweight_uploader.RetryPolicy(max_retries=1, base_delay=10, jitter=0)
+        )
+        self.mock_response.status = 503
+        self.mock_response.reason = 'fake reason to 503'
+        before = time()
+        self.assertEquals(123456, self.target.post_next_chunk())
+        self.assertTrue(before + 10 <= self.target.retry_at <= time() + 10)
+        self.assertEquals(False, mock_on_complete.called)
+
+        self.assertEquals(-1, self.target.post_next_chunk())
+        mock_on_complete.assert_called_once_with(response=self.mock_response)
+
+    def test_connection_error_schedules_retry(self):
+        self.target = py_lightweight_uploader.UploadableFile(
+            '/path/to/fake_file_name.txt',
+            'http://fake.destination/url?a=b&c=d',
+            self.mock_http_connection,
+        )
+        self.mock_http_connection.request.side_effect = socket.error(104, 'Connection reset by peer')
+        self.assertEquals(123456, self.target.post_next_chunk())
+        self.assertEquals(1, self.target.retries)
+        self.assertEquals(None, self.target.response)
+
+    def test_requests_and_retries_are_counted(self):
+        self.target = py_lightweight_uploader.UploadableFile(
+            '/path/to/fake_file_name.txt',
+            'http://fake.destination/url?a=b&c=d',
+            self.mock_http_connection,
+        )
+        self.target.metrics = Mock(spec=py_lightweight_uploader.UploadMetrics)
+        self.mock_response.status = 201
+        self.mock_response.getheader.return_value = '0-51200/123456'
+        self.target.post_next_chunk()
+        self.assertEquals(51201, self.target.metrics.chunk_sent.call_args[0][0])
+        self.mock_response.status = 503
+        self.mock_response.reason = 'fake reason to 503'
+        self.target.post_next_chunk()
+        self.assertEquals(2, self.target.metrics.chunk_sent.call_count)
+        self.target.metrics.retried.assert_called_once_with()
+        self.assertEquals((51201, 123456), self.target.progress)
+
+    def test_file_handle_is_only_held_during_a_chunk(self):
+        self.target = py_lightweight_uploader.UploadableFile(
+            '/path/to/fake_file_name.txt',
+            'http://fake.destination/url?a=b&c=d',
+            self.mock_http_connection,
+        )
+        self.target.file_handles = py_lightweight_uploader.FileHandleCache(max_open=1)
+        self.mock_response.status = 201
+        self.mock_response.getheader.return_value = '0-51200/123456'
+        self.target.post_next_chunk()
+        self.mock_stat.assert_called_once_with('/path/to/fake_file_name.txt')
+        self.assertEquals(None, self.target._file_handle)
+        self.assertEquals(1, len(self.target.file_handles.idle))
+
+        self.mock_response.status = 403
+        self.mock_response.reason = 'fake reason to 403'
+        self.assertEquals(-1, self.target.post_next_chunk())
+        self.assertEquals(1, self.mock_open.call_count)
+        self.mock_open.return_value.close.assert_called_once_with()
+        self.assertEquals(0, len(self.target.file_handles))
+
+    def test_compressed_upload(self):
+        content = '{"receipt": "fake receipt"}\n' * 1000
+        self.target = py_lightweight_uploader.UploadableFile(
+            '/path/to/fake_file_name.json',
+            'http://fake.destination/url?a=b&c=d',
+            self.mock_http_connection,
+            content=content,
+            chunk_size=len(content),
+            compression=py_lightweight_uploader.GzipCodec()
+        )
+        self.mock_response.status = 200
+        self.mock_http_connection.request.side_effect = lambda method, uri, body, headers: sent.append(body.read())
+        sent = []
+        self.assertEquals(0, self.target.post_next_chunk())
+        headers = self.mock_http_connection.request.call_args[0][3]
+        self.assertEquals('gzip', headers['Content-Encoding'])
+        self.assertEquals('application/json', headers['Content-Type'])
+        self.assertTrue(self.target.total_file_size < len(content) / 10)
+        self.assertEquals('bytes 0-%d/%d' % (self.target.total_file_size - 1, self.target.total_file_size),
+                          headers['X-Content-Range'])
+        self.assertEquals(content, zlib.decompress(sent[0], 16 + zlib.MAX_WBITS))
+
+    def test_compressed_file_counts_against_file_handles(self):
+        content = '{"receipt": "fake receipt"}\n' * 1000
+        self.target = py_lightweight_uploader.UploadableFile(
+            '/path/to/fake_file_name.json',
+            'http://fake.destination/url?a=b&c=d',
+            self.mock_http_connection,
+            content=content,
+            chunk_size=100,
+            compression=py_lightweight_uploader.GzipCodec()
+        )
+        self.target.file_handles = py_lightweight_uploader.FileHandleCache(max_open=1)
+        self.mock_response.status = 201
+        self.mock_response.getheader.return_value = '0-100/200'
+        self.target.post_next_chunk()
+        self.assertEquals(None, self.target._file_handle)
+        self.assertEquals(1, len(self.target.file_handles.idle))
+        self.target.close()
+        self.assertEquals(0, len(self.target.file_handles))
+
+    def test_compression_skips_compressed_file_types(self):
+        for file_name in ('receipt.png', 'receipts.zip', 'receipts.tar.gz'):
+            self.target = py_lightweight_uploader.UploadableFile(
+                file_name,
+                'http://fake.destination/url?a=b&c=d',
+                self.mock_http_connection,
+                content='fake content',
+                compression=py_lightweight_uploader.ZlibCodec()
+            )
+            self.assertFalse(self.target.is_compressed, file_name)
+            self.assertFalse('Content-Encoding' in self.target.simple_headers())
+            self.assertEquals(12, self.target.total_file_size)
+
+    def test_progress_and_chunk_callbacks(self):
+        mock_on_progress = Mock()
+        mock_on_chunk = Mock()
+        self.target = py_lightweight_uploader.UploadableFile(
+            '/path/to/fake_file_name.txt',
+            'http://fake.destination/url?a=b&c=d',
+            self.mock_http_connection,
+            on_progress=mock_on_progress,
+            on_chunk=mock_on_chunk
+        )
+        self.target.upload_id = 'fake_id'
+        self.mock_response.status = 201
+        self.mock_response.getheader.return_value = '0-51200/123456'
+        self.target.post_next_chunk()
+        mock_on_progress.assert_called_once_with('fake_id', 51201, 123456)
+        self.assertEquals(('fake_id', (0, 51200)), mock_on_chunk.call_args[0][:2])
+
+        self.target.callbacks = Mock(spec=py_lightweight_uploader.CallbackDispatcher)
+        self.mock_response.status = 200
+        self.target.post_next_chunk()
+        self.assertEquals(1, mock_on_progress.call_count)
+        self.target.callbacks.post.assert_called_with(
+            ('fake_id', 'progress'), mock_on_progress, 'fake_id', 123456, 123456)
+
+    def test_redirect_is_followed_with_the_same_session(self):
+        mock_pool = Mock(spec=py_lightweight_uploader.ConnectionPool)
+        mock_pool.acquire.return_value = self.mock_http_connection
+        self.target = py_lightweight_uploader.UploadableFile(
+            '/path/to/fake_file_name.txt',
+            'http://fake.destination/url?a=b&c=d',
+            connection_pool=mock_pool,
+        )
+        self.target.redirect_cache = py_lightweight_uploader.RedirectCache()
+        self.mock_response.status = 307
+        self.mock_response.getheader.return_value = 'http://elsewhere/url2'
+        self.assertEquals(123456, self.target.post_next_chunk())
+        self.assertEquals('http://elsewhere/url2?a=b&c=d', urlunparse(self.target.destination_url))
+        self.assertEquals(0, self.target.retry_at)
+        self.assertEquals(0, self.target.next_byte_to_upload)
+        self.assertEquals({}, self.target.redirect_cache.targets)      # temporary, so not remembered
+
+        self.mock_response.status = 201
+        self.mock_response.getheader.return_value = '0-51200/123456'
+        self.target.post_next_chunk()
+        first, second = self.mock_http_connection.request.call_args_list
+        self.assertEquals('/url?a=b&c=d', first[0][1])
+        self.assertEquals('/url2?a=b&c=d', second[0][1])
+        self.assertEquals(first[0][3], second[0][3])                    # Session-ID, X-Content-Range and all
+        mock_pool.acquire.assert_called_with(self.target.destination_url, True)
+        self.assertEquals(0, self.target.redirects)
+
+    def test_permanent_redirect_is_cached(self):
+        self.target = py_lightweight_uploader.UploadableFile(
+            '/path/to/fake_file_name.txt',
+            'http://fake.destination/url?a=b&c=d',
+            self.mock_http_connection,
+        )
+        self.target.redirect_cache = py_lightweight_uploader.RedirectCache()
+        self.mock_response.status = 301
+        self.mock_response.getheader.return_value = '/moved'             # relative to where we posted
+        self.target.post_next_chunk()
+        self.assertEquals('http://fake.destination/moved?a=b&c=d',
+                          urlunparse(self.target.destination_url))
+        self.assertEquals('http://fake.destination/moved?x=y', urlunparse(
+            self.target.redirect_cache.resolve(urlparse('http://fake.destination/url?x=y'))))
+
+    def test_too_many_redirects_fail_the_upload(self):
+        mock_on_complete = Mock()
+        self.target = py_lightweight_uploader.UploadableFile(
+            '/path/to/fake_file_name.txt',
+            'http://fake.destination/url?a=b&c=d',
+            self.mock_http_connection,
+            on_complete=mock_on_complete,
+        )
+        self.mock_response.status = 308
+        self.mock_response.reason = 'Permanent Redirect'
+        self.mock_response.getheader.return_value = '/url'               # right back where we were
+        for i in range(self.target.max_redirects):
+            self.assertEquals(123456, self.target.post_next_chunk())
+        self.assertEquals(-1, self.target.post_next_chunk())
+        mock_on_complete.assert_called_once_with(response=self.mock_response)
+
+    def test_redirect_without_location_fails(self):
+        self.target = py_lightweight_uploader.UploadableFile(
+            '/path/to/fake_file_name.txt',
+            'http://fake.destination/url?a=b&c=d',
+            self.mock_http_connection,
+        )
+        self.mock_response.status = 302
+        self.mock_response.reason = 'Found'
+        self.mock_response.getheader.return_value = None
+        self.assertEquals(-1, self.target.post_next_chunk())
+
+    def test_borrows_connection_from_pool(self):
+        mock_pool = Mock(spec=py_lightweight_uploader.ConnectionPool)
+        mock_pool.acquire.return_value = self.mock_http_connection
+        self.target = py_lightweight_uploader.UploadableFile(
+            '/path/to/fake_file_name.txt',
+            'http://fake.destination/url?a=b&c=d',
+            connection_pool=mock_pool,
+        )
+        self.mock_response.status = 201
+        self.mock_response.getheader.return_value = '0-51200/123456'
+        self.target.post_next_chunk()
+        mock_pool.acquire.assert_called_once_with(self.target.destination_url, True)
+        mock_pool.release.assert_called_once_with(self.target.destination_url, self.mock_http_connection)
+
+    def test_chunk_size_policy_is_consulted(self):
+        mock_policy = Mock(spec=py_lightweight_uploader.FixedChunkSize)
+        mock_policy.chunk_sent.return_value = 1000
+        self.target = py_lightweight_uploader.UploadableFile(
+            '/path/to/fake_file_name.txt',
+            'http://fake.destination/url?a=b&c=d',
+            self.mock_http_connection,
+            chunk_size_policy=mock_policy,
+        )
+        self.mock_response.status = 201
+        self.mock_response.getheader.return_value = '0-51200/123456'
+        self.target.post_next_chunk()
+        self.assertEquals(51200, mock_policy.chunk_sent.call_args[0][0])
+        self.assertEquals(51201, mock_policy.chunk_sent.call_args[0][1])
+        self.assertEquals(1000, self.target.chunk_size)
+        self.assertEquals('bytes 51201-52201/123456', self.target.next_content_range)
+
+    def test_every_byte_confirmed_without_a_200_sends_the_end_again(self):
+        mock_on_complete = Mock()
+        mock_pool = Mock(spec=py_lightweight_uploader.ConnectionPool)
+        mock_pool.acquire.return_value = self.mock_http_connection
+        self.target = py_lightweight_uploader.UploadableFile(
+            '/path/to/fake_file_name.txt',
+            'http://fake.destination/url?a=b&c=d',
+            connection_pool=mock_pool,
+            on_complete=mock_on_complete,
+            retry_policy=py_lightweight_uploader.RetryPolicy(max_retries=2, base_delay=0),
+        )
+        self.mock_response.status = 201
+        self.mock_response.reason = 'Created'
+        self.mock_response.getheader.return_value = '0-123455/123456'
+        self.assertEquals(1, self.target.post_next_chunk())
+        self.assertEquals(False, mock_on_complete.called)
+        self.assertEquals('bytes 72255-123455/123456', self.target.next_content_range)
+
+        self.mock_response.status = 200
+        self.assertEquals(0, self.target.post_next_chunk())
+        mock_on_complete.assert_called_once_with(response=self.mock_response)
+        headers = self.mock_http_connection.request.call_args[0][3]
+        self.assertEquals('bytes 72255-123455/123456', headers['X-Content-Range'])
+
+    def test_every_byte_confirmed_without_a_200_fails_once_retries_run_out(self):
+        mock_on_complete = Mock()
+        mock_pool = Mock(spec=py_lightweight_uploader.ConnectionPool)
+        mock_pool.acquire.return_value = self.mock_http_connection
+        self.target = py_lightweight_uploader.UploadableFile(
+            '/path/to/fake_file_name.txt',
+            'http://fake.destination/url?a=b&c=d',
+            connection_pool=mock_pool,
+            on_complete=mock_on_complete,
+            parallel_chunks=2,
+            retry_policy=py_lightweight_uploader.RetryPolicy(max_retries=2, base_delay=0),
+        )
+        self.target.received_ranges = [(0, 99)]
+        self.mock_response.status = 201
+        self.mock_response.reason = 'Created'
+        self.mock_response.getheader.return_value = '0-123455/123456'
+        self.assertEquals([1, 1, -1], [self.target.post_next_chunk() for i in range(3)])
+        self.assertEquals('bytes 72255-123455/123456',
+                          self.mock_http_connection.request.call_args[0][3]['X-Content-Range'])
+        mock_on_complete.assert_called_once_with(response=self.mock_response)
+
+    def test_server_reply_replaces_what_it_said_before(self):
+        self.target = py_lightweight_uploader.UploadableFile(
+            '/path/to/fake_file_name.txt',
+            'http://fake.destination/url?a=b&c=d',
+            self.mock_http_connection,
+            received_ranges=[(0, 99999)],
+        )
+        self.mock_response.status = 201
+        self.mock_response.getheader.return_value = '100000-123455/123456'     # lost the session's start
+        self.assertEquals(100000, self.target.post_next_chunk())
+        self.assertEquals([(100000, 123455)], self.target.received_ranges)
+        self.assertEquals(0, self.target.next_byte_to_upload)
+
+    def test_planned_chunks_fill_holes(self):
+        self.target = py_lightweight_uploader.UploadableFile(
+            '/path/to/fake_file_name.txt',
+            'http://fake.destination/url?a=b&c=d',
+            self.mock_http_connection,
+            chunk_size=99,
+        )
+        self.target.received_ranges = [(0, 99), (150, 349)]
+        self.assertEquals([(100, 149), (350, 449), (450, 549)], self.target.planned_chunks(3))
+
+    def test_parse_received_ranges(self):
+        self.assertEquals([(0, 99), (200, 399)],
+                          py_lightweight_uploader.parse_received_ranges('300-399,0-99,200-299/123456'))
+        self.assertEquals([], py_lightweight_uploader.parse_received_ranges(''))
+
+    def test_post_parallel_chunks(self):
+        second_connection = Mock(spec=HTTPConnection)
+        second_response = Mock(spec=HTTPResponse)
+        second_connection.getresponse.return_value = second_response
+        self.target = py_lightweight_uploader.UploadableFile(
+            '/path/to/fake_file_name.txt',
+            'http://fake.destination/url?a=b&c=d',
+            self.mock_http_connection,
+            parallel_chunks=2,
+        )
+        self.target.parallel_connections = [second_connection]
+        self.mock_response.status = 201
+        self.mock_response.getheader.return_value = '0-51200/123456'
+        second_response.status = 201
+        second_response.getheader.return_value = '51201-102401/123456'
+
+        remaining = self.target.post_next_chunk()
+
+        self.assertEquals([(0, 102401)], self.target.received_ranges)
+        self.assertEquals(102402, self.target.next_byte_to_upload)
+        self.assertEquals(123456 - 102402, remaining)
+        self.assertEquals('bytes 0-51200/123456',
+                          self.mock_http_connection.request.call_args[0][3]['X-Content-Range'])
+        self.assertEquals('bytes 51201-102401/123456',
+                          second_connection.request.call_args[0][3]['X-Content-Range'])
+        self.assertEquals(6543217, second_connection.request.call_args[0][3]['Session-ID'])
+
+    def test_post_parallel_chunks_completes(self):
+        mock_on_complete = Mock()
+        second_connection = Mock(spec=HTTPConnection)
+        second_response = Mock(spec=HTTPResponse)
+        second_connection.getresponse.return_value = second_response
+        self.target = py_lightweight_uploader.UploadableFile(
+            '/path/to/fake_file_name.txt',
+            'http://fake.destination/url?a=b&c=d',
+            self.mock_http_connection,
+            on_complete=mock_on_complete,
+            parallel_chunks=2,
+        )
+        self.target.parallel_connections = [second_connection]
+        self.target.received_ranges = [(0, 20000)]
+        self.mock_response.status = 201
+        self.mock_response.getheader.return_value = '0-71201/123456'
+        second_response.status = 200
+
+        self.assertEquals(0, self.target.post_next_chunk())
+        self.assertTrue(self.target.is_done)
+        mock_on_complete.assert_called_once_with(response=second_response)
+
+
+class TestConnectionPool(PatchedTestCase): pass
+@TestConnectionPool.patch('py_lightweight_uploader.debug', spec=debug)
+@TestConnectionPool.patch('py_lightweight_uploader.NoDelayHTTPConnection', spec=HTTPConnection)
+@TestConnectionPool.patch('py_lightweight_uploader.NoDelayHTTPSConnection', spec=HTTPSConnection)
+class TestConnectionPool(PatchedTestCase):
+
+    def postSetUpPreRun(self):
+        self.mock_NoDelayHTTPConnection.side_effect = lambda netloc: Mock(spec=HTTPConnection)
+        self.url = py_lightweight_uploader.urlparse('http://fake.destination/url')
+        self.target = py_lightweight_uploader.ConnectionPool(max_per_host=2, idle_timeout=60.0)
+
+    def test_reuses_released_connection(self):
+        connection = self.target.acquire(self.url)
+        self.target.release(self.url, connection)
+        self.assertTrue(connection is self.target.acquire(self.url))
+        self.assertEquals(1, self.mock_NoDelayHTTPConnection.call_count)
+
+    def test_https_scheme(self):
+        self.target.acquire(py_lightweight_uploader.urlparse('https://fake.destination/url'))
+        self.mock_NoDelayHTTPSConnection.assert_called_once_with('fake.destination')
+        self.assertEquals(False, self.mock_NoDelayHTTPConnection.called)
+
+    def test_unknown_scheme(self):
+        self.assertRaises(ValueError, self.target.acquire, py_lightweight_uploader.urlparse('ftp://fake.destination/'))
+
+    def test_failed_connection_gives_its_slot_back(self):
+        url = py_lightweight_uploader.urlparse('ftp://fake.destination/')
+        for i in range(self.target.max_per_host + 1):
+            self.assertRaises(ValueError, self.target.acquire, url, False)
+        self.assertEquals(0, self.target.in_use[self.target.key(url)])
+
+    def test_limit_per_host(self):
+        self.target.acquire(self.url)
+        self.target.acquire(self.url)
+        self.assertEquals(None, self.target.acquire(self.url, block=False))
+        other_host = py_lightweight_uploader.urlparse('http://other.destination/url')
+        self.assertNotEqual(None, self.target.acquire(other_host, block=False))
+
+    def test_idle_connections_are_closed(self):
+        connection = self.target.acquire(self.url)
+        self.target.release(self.url, connection)
+        self.target.idle[('http', 'fake.destination')] = [(connection, time() - 61)]
+        self.assertFalse(connection is self.target.acquire(self.url))
+        connection.close.assert_called_once_with()
+
+
+class TestFileHandleCache(PatchedTestCase): pass
+@TestFileHandleCache.patch('py_lightweight_uploader.open', create=True)
+class TestFileHandleCache(PatchedTestCase):
+
+    def postSetUpPreRun(self):
+        self.mock_open.side_effect = lambda file_name, mode: MagicMock(spec=file, name=file_name)
+        self.target = py_lightweight_uploader.FileHandleCache(max_open=2)
+        self.files = [Mock(file_name='fake_filename_%d' % i) for i in range(3)]
+
+    def test_reuses_released_handle(self):
+        handle = self.target.open(self.files[0])
+        self.target.release(self.files[0])
+        self.assertTrue(handle is self.target.open(self.files[0]))
+        self.assertEquals(1, self.mock_open.call_count)
+
+    def test_closes_least_recently_used_when_over_budget(self):
+        handles = [self.target.open(f) for f in self.files[:2]]
+        self.target.release(self.files[1])
+        self.target.release(self.files[0])
+        self.target.open(self.files[2])
+        self.assertEquals(1, handles[1].close.call_count)
+        self.assertEquals(0, handles[0].close.call_count)
+        self.assertEquals(2, len(self.target))
+
+    def test_discard_closes(self):
+        handle = self.target.open(self.files[0])
+        self.target.discard(self.files[0])
+        handle.close.assert_called_once_with()
+        self.assertEquals(0, len(self.target))
+
+    def test_opener_takes_a_place_in_the_budget(self):
+        opener = Mock(name='opener')
+        self.assertTrue(opener.return_value is self.target.open(self.files[0], opener))
+        opener.assert_called_once_with(self.files[0])
+        self.assertEquals(0, self.mock_open.call_count)
+        self.target.release(self.files[0])
+        self.target.open(self.files[1])
+        self.target.open(self.files[2])
+        opener.return_value.close.assert_called_once_with()
+
+    def test_opener_failing_gives_its_place_back(self):
+        opener = Mock(name='opener', side_effect=IOError('fake disk full'))
+        self.assertRaises(IOError, self.target.open, self.files[0], opener)
+        self.assertEquals(0, len(self.target))
+
+
+class TestTokenBucket(PatchedTestCase): pass
+@TestTokenBucket.patch('py_lightweight_uploader.time')
+@TestTokenBucket.patch('py_lightweight_uploader.sleep')
+class TestTokenBucket(PatchedTestCase):
+
+    def postSetUpPreRun(self):
+        self.mock_time.return_value = 1000.0
+
+    def test_unlimited_never_sleeps(self):
+        target = py_lightweight_uploader.TokenBucket()
+        target.consume(10 ** 9)
+        self.assertEquals(False, self.mock_sleep.called)
+
+    def test_sleeps_off_the_debt(self):
+        target = py_lightweight_uploader.TokenBucket(rate=1000, burst=1000)
+        target.consume(500)
+        self.mock_sleep.assert_called_once_with(0.5)
+
+    def test_refills_over_time_up_to_burst(self):
+        target = py_lightweight_uploader.TokenBucket(rate=1000, burst=2000)
+        self.mock_time.return_value = 1010.0
+        target.consume(2000)
+        self.assertEquals(False, self.mock_sleep.called)
+        target.consume(1000)
+        self.mock_sleep.assert_called_once_with(1.0)
+
+    def test_rate_can_change_at_runtime(self):
+        target = py_lightweight_uploader.TokenBucket(rate=1000)
+        target.set_rate(None)
+        target.consume(10 ** 9)
+        self.assertEquals(False, self.mock_sleep.called)
+        target.set_rate(100)
+        target.consume(50)
+        self.mock_sleep.assert_called_once_with(0.5)
+
+    def test_chunk_reader_pays_for_each_block(self):
+        throttle = Mock(spec=py_lightweight_uploader.TokenBucket)
+        target = py_lightweight_uploader.ChunkReader(StringIO('0123456789'), 0, 9, throttles=[throttle])
+        target.read(8)
+        target.read(8)
+        self.assertEquals([((8,), {}), ((2,), {})], throttle.consume.call_args_list)
+
+
+class TestUploadMetrics(PatchedTestCase): pass
+@TestUploadMetrics.patch('py_lightweight_uploader.time')
+class TestUploadMetrics(PatchedTestCase):
+
+    def postSetUpPreRun(self):
+        self.mock_time.return_value = 1000.0
+        self.target = py_lightweight_uploader.UploadMetrics(window=10.0)
+
+    def test_latency_histogram_is_cumulative(self):
+        for elapsed in (0.003, 0.2, 0.25, 100):
+            self.target.chunk_sent(10, elapsed)
+        snapshot = self.target.snapshot()
+        buckets = dict(snapshot['latency_buckets'])
+        self.assertEquals(1, buckets[0.005])
+        self.assertEquals(1, buckets[0.1])
+        self.assertEquals(3, buckets[0.25])
+        self.assertEquals(3, buckets[60.0])
+        self.assertEquals(4, buckets[float('inf')])
+        self.assertEquals(4, snapshot['latency_count'])
+        self.assertEquals(40, snapshot['bytes_sent'])
+        self.assertEquals(4, snapshot['chunks_sent'])
+
+    def test_throughput_covers_the_window(self):
+        self.mock_time.return_value = 1020.0
+        self.target.chunk_sent(1000, 0.1)
+        self.mock_time.return_value = 1025.0
+        self.target.chunk_sent(4000, 0.1)
+        self.assertEquals(500.0, self.target.snapshot()['throughput'])
+        self.mock_time.return_value = 1032.0
+        self.assertEquals(400.0, self.target.snapshot()['throughput'])
+
+
+class TestCallbackDispatcher(PatchedTestCase): pass
+@TestCallbackDispatcher.patch('py_lightweight_uploader.warning', spec=warning)
+class TestCallbackDispatcher(PatchedTestCase):
+
+    def test_calls_are_coalesced_per_interval(self):
+        target = py_lightweight_uploader.CallbackDispatcher(interval=0.05)
+        calls = []
+        first_call = Event()
+        last_call = Event()
+        def callback(id, sent):
+            calls.append((id, sent, time()))
+            (last_call if sent == 3 else first_call).set()
+        target.post(('fake_id', 'progress'), callback, 'fake_id', 1)
+        self.assertTrue(first_call.wait(5))
+        target.post(('fake_id', 'progress'), callback, 'fake_id', 2)
+        target.post(('fake_id', 'progress'), callback, 'fake_id', 3)
+        self.assertTrue(last_call.wait(5))
+        self.assertEquals([1, 3], [sent for id, sent, called in calls])
+        self.assertTrue(calls[1][2] - calls[0][2] >= 0.04)
+
+    def test_callback_exception_is_logged(self):
+        target = py_lightweight_uploader.CallbackDispatcher(interval=0)
+        raised = Event()
+        called = Event()
+        def broken():
+            raised.set()
+            raise ValueError('fake error')
+        target.post('broken', broken)
+        self.assertTrue(raised.wait(5))
+        target.post('working', called.set)
+        self.assertTrue(called.wait(5))
+        self.assertEquals(1, self.mock_warning.call_count)
+
+
+class TestUploadCache(unittest2.TestCase):
+
+    def setUp(self):
+        self.target = py_lightweight_uploader.UploadCache(max_entries=2)
+
+    def test_file_content_is_hashed_in_blocks(self):
+        self.target.block_size = 4
+        self.assertEquals(
+            self.target.key(py_lightweight_uploader.UploadableFile('a', 'http://fake_uploadurl/', content='fake content')),
+            self.target.key(py_lightweight_uploader.UploadableFile('a', 'http://fake_uploadurl/', content=StringIO('fake content'))))
+        self.assertNotEqual(
+            self.target.key(py_lightweight_uploader.UploadableFile('a', 'http://fake_uploadurl/', content='fake content')),
+            self.target.key(py_lightweight_uploader.UploadableFile('b', 'http://fake_uploadurl/', content='fake content')))
+
+    def test_unicode_content_is_hashed_like_a_string(self):
+        self.assertEquals(
+            self.target.key(py_lightweight_uploader.UploadableFile('a', 'http://fake_uploadurl/', content=u'fake content')),
+            self.target.key(py_lightweight_uploader.UploadableFile('a', 'http://fake_uploadurl/', content='fake content')))
+        target = py_lightweight_uploader.LightweightUploader(cache=self.target)
+        target.enqueue_upload('a.txt', 'http://fake_uploadurl/', content=u'receipt text')
+        self.assertEquals(1, len(target.uploads))
+
+    def test_least_recently_used_is_evicted(self):
+        self.target.put('a', 'response a')
+        self.target.put('b', 'response b')
+        self.assertEquals('response a', self.target.get('a'))
+        self.target.put('c', 'response c')
+        self.assertEquals(None, self.target.get('b'))
+        self.assertEquals('response a', self.target.get('a'))
+        self.assertEquals('response c', self.target.get('c'))
+
+    def test_expires_after_ttl(self):
+        self.target.ttl = 0
+        self.target.put('a', 'response a')
+        self.assertEquals(None, self.target.get('a'))
+        self.assertEquals(0, len(self.target.completed))
+
+
+class TestDestinationGroup(PatchedTestCase): pass
+@TestDestinationGroup.patch('py_lightweight_uploader.warning', spec=warning)
+@TestDestinationGroup.patch('py_lightweight_uploader.time')
+class TestDestinationGroup(PatchedTestCase):
+
+    urls = ['http://host_a/upload', 'http://host_b/upload', 'http://host_c/upload']
+
+    def postSetUpPreRun(self):
+        self.mock_time.return_value = 1000.0
+
+    def new_file(self, group, content='x' * 100):
+        return py_lightweight_uploader.UploadableFile('fake_file', group, content=content,
+                                                      additional_data={'batch': '42'})
+
+    def test_least_outstanding_bytes(self):
+        target = py_lightweight_uploader.DestinationGroup(self.urls)
+        files = [self.new_file(target, 'x' * size) for size in (1000, 1, 100, 50)]
+        for f in files:
+            f.choose_destination('fake_id')
+        self.assertEquals([0, 1, 2, 1], [f.destination_host for f in files])
+        self.assertEquals([1000, 51, 100], target.outstanding)
+        self.assertEquals('host_b', files[1].destination_url.netloc)
+        self.assertEquals('batch=42', files[1].destination_url.query)
+        files[0].close()
+        files[0].close()
+        self.assertEquals([0, 51, 100], target.outstanding)
+
+    def test_consistent_hash_of_upload_id(self):
+        target = py_lightweight_uploader.DestinationGroup(self.urls, strategy='consistent_hash')
+        hosts = [target.assign(self.new_file(target), 'upload_%d' % i, 100) for i in range(300)]
+        self.assertEquals(set([0, 1, 2]), set(hosts))
+        self.assertEquals(hosts, [target.assign(self.new_file(target), 'upload_%d' % i, 100) for i in range(300)])
+        # Without host_c, only what went to host_c moves.
+        fewer = py_lightweight_uploader.DestinationGroup(self.urls[:2], strategy='consistent_hash')
+        for i, host in enumerate(hosts):
+            if host != 2:
+                self.assertEquals(host, fewer.assign(self.new_file(fewer), 'upload_%d' % i, 100))
+
+    def test_down_after_max_failures_until_down_for(self):
+        target = py_lightweight_uploader.DestinationGroup(self.urls[:2], max_failures=2, down_for=30)
+        target.failed(0)
+        self.assertFalse(target.is_down(0))
+        target.failed(0)
+        self.assertTrue(target.is_down(0))
+        self.assertEquals(1, self.mock_warning.call_count)
+        self.assertEquals([1, 1, 1], [target.assign(self.new_file(target), None, 0) for i in range(3)])
+        self.mock_time.return_value = 1030.0
+        self.assertFalse(target.is_down(0))
+        target.failed(0)                    # still failing, straight back down
+        self.assertTrue(target.is_down(0))
+        self.mock_time.return_value = 1060.0
+        target.succeeded(0)
+        target.failed(0)
+        self.assertFalse(target.is_down(0))
+
+    def test_every_host_down_still_gets_uploads(self):
+        target = py_lightweight_uploader.DestinationGroup(self.urls[:1], max_failures=1)
+        target.failed(0)
+        self.assertEquals(0, target.assign(self.new_file(target), None, 0))
+
+    def test_bad_arguments(self):
+        self.assertRaises(ValueError, py_lightweight_uploader.DestinationGroup, [])
+        self.assertRaises(ValueError, py_lightweight_uploader.DestinationGroup, self.urls, strategy='round_robin')
+
+    def test_upload_fails_over_and_starts_a_new_session(self):
+        target = py_lightweight_uploader.DestinationGroup(self.urls[:2], max_failures=1)
+        f = self.new_file(target)
+        f.retry_policy = py_lightweight_uploader.RetryPolicy(max_retries=3, base_delay=5, jitter=0)
+        f.choose_destination('fake_id')
+        f._session_id = 1234
+        f.received_ranges = [(0, 49)]
+        f.next_byte_to_upload = 50
+        target.failed(f.destination_host)
+        f.response = None
+        self.assertEquals(100, f.upload_failed())
+        self.assertEquals('host_b', f.destination_url.netloc)
+        self.assertEquals(1000.0, f.retry_at)
+        self.assertEquals([], f.received_ranges)
+        self.assertEquals(0, f.next_byte_to_upload)
+        self.assertNotEquals(1234, f.session_id)
+        self.assertEquals([0, 100], target.outstanding)
+
+    def test_upload_sticks_to_a_healthy_host(self):
+        target = py_lightweight_uploader.DestinationGroup(self.urls[:2], max_failures=2)
+        f = self.new_file(target)
+        f.retry_policy = py_lightweight_uploader.RetryPolicy(max_retries=3, base_delay=5, jitter=0)
+        f.choose_destination('fake_id')
+        f.received_ranges = [(0, 49)]
+        target.failed(f.destination_host)
+        f.response = None
+        self.assertEquals(50, f.upload_failed())
+        self.assertEquals('host_a', f.destination_url.netloc)
+        self.assertEquals([(0, 49)], f.received_ranges)
+        self.assertEquals(1005.0, f.retry_at)
+
+
+class TestRedirectCache(PatchedTestCase): pass
+@TestRedirectCache.patch('py_lightweight_uploader.time')
+class TestRedirectCache(PatchedTestCase):
+
+    def postSetUpPreRun(self):
+        self.mock_time.return_value = 1000.0
+        self.target = py_lightweight_uploader.RedirectCache(ttl=60, max_entries=2)
+
+    def resolve(self, url):
+        return urlunparse(self.target.resolve(urlparse(url)))
+
+    def test_follows_chains_keeping_the_query(self):
+        self.target.put(urlparse('http://a/upload'), urlparse('http://b/upload'))
+        self.target.put(urlparse('http://b/upload'), urlparse('https://c/up'))
+        self.assertEquals('https://c/up?batch=42', self.resolve('http://a/upload?batch=42'))
+        self.assertEquals('http://a/other', self.resolve('http://a/other'))
+
+    def test_expires_after_ttl(self):
+        self.target.put(urlparse('http://a/upload'), urlparse('http://b/upload'))
+        self.mock_time.return_value = 1060.0
+        self.assertEquals('http://a/upload', self.resolve('http://a/upload'))
+        self.assertEquals(0, len(self.target.targets))
+
+    def test_least_recently_seen_is_evicted(self):
+        for host in 'abc':
+            self.target.put(urlparse('http://%s/upload' % host),
+                            urlparse('http://new_%s/upload' % host))
+        self.assertEquals('http://a/upload', self.resolve('http://a/upload'))
+        self.assertEquals('http://new_c/upload', self.resolve('http://c/upload'))
+
+
+class TestRetryPolicy(unittest2.TestCase):
+
+    def setUp(self):
+        self.target = py_lightweight_uploader.RetryPolicy(max_retries=3, base_delay=1.0, max_delay=5.0, jitter=0.5)
+
+    def test_retryable(self):
+        for status in (408, 429, 500, 502, 503, 504):
+            self.assertTrue(self.target.should_retry(0, Mock(status=status)))
+        self.assertTrue(self.target.should_retry(0, None))
+        for status in (400, 403, 404, 413):
+            self.assertFalse(self.target.should_retry(0, Mock(status=status)))
+
+    def test_budget(self):
+        self.assertTrue(self.target.should_retry(2, None))
+        self.assertFalse(self.target.should_retry(3, None))
+
+    def test_exponential_backoff_with_jitter(self):
+        for retries, top in ((0, 1.0), (1, 2.0), (2, 4.0), (3, 5.0), (10, 5.0)):
+            delay = self.target.delay(retries)
+            self.assertTrue(top / 2 <= delay <= top, (retries, delay))
+
+
+class TestChunkReader(unittest2.TestCase):
+
+    def test_reads_only_its_range_of_a_file(self):
+        target = py_lightweight_uploader.ChunkReader(StringIO('0123456789'), 2, 6)
+        self.assertEquals(5, len(target))
+        self.assertEquals('234', target.read(3))
+        self.assertEquals('56', target.read(8192))
+        self.assertEquals('', target.read(8192))
+
+    def test_readers_of_one_file_do_not_interfere(self):
+        source = StringIO('0123456789')
+        first = py_lightweight_uploader.ChunkReader(source, 0, 4)
+        second = py_lightweight_uploader.ChunkReader(source, 5, 9)
+        self.assertEquals('01', first.read(2))
+        self.assertEquals('56', second.read(2))
+        self.assertEquals('234', first.read())
+        self.assertEquals('789', second.read())
+
+
+class TestAdaptiveChunkSize(unittest2.TestCase):
+
+    def setUp(self):
+        self.target = py_lightweight_uploader.AdaptiveChunkSize(
+            min_size=1000, max_size=100000, target_seconds=1.0, max_step=2.0)
+
+    def test_grows_on_fast_link(self):
+        self.assertEquals(20000, self.target.chunk_sent(10000, 10000, 0.5))
+
+    def test_growth_is_limited_per_step(self):
+        self.assertEquals(20000, self.target.chunk_sent(10000, 10000, 0.01))
+
+    def test_shrinks_on_slow_link(self):
+        self.assertEquals(8000, self.target.chunk_sent(10000, 10000, 1.25))
+
+    def test_stays_within_bounds(self):
+        self.assertEquals(100000, self.target.chunk_sent(80000, 80000, 0.1))
+        self.assertEquals(1000, self.target.chunk_sent(1500, 1500, 10))
+
+    def test_halves_on_failure(self):
+        self.assertEquals(5000, self.target.chunk_failed(10000))
+        self.assertEquals(1000, self.target.chunk_failed(1200))
+
 
 class TestLightweightUploader(PatchedTestCase): pass
 @TestLightweightUploader.patch('py_lightweight_uploader.debug', spec=debug)
@@ -277,6 +1184,8 @@ class TestLightweightUploader(PatchedTestCase):
 
     def postSetUpPreRun(self):
         self.mock_file = Mock(spec=py_lightweight_uploader.UploadableFile)
+        self.mock_file.bytes_posted = 0
+        self.mock_file.retry_at = 0
 
     # The following two tests know entirely too much about the internal implementation of the LWU. :(
 
@@ -284,13 +1193,16 @@ class TestLightweightUploader(PatchedTestCase):
         target = py_lightweight_uploader.LightweightUploader()
         id = target.enqueue_upload('fake_filename', 'http://fake_uploadurl/')
         self.assertEquals(1, len(target.upload_queue))
-        self.assertEquals(id, target.upload_queue[0].id)
+        self.assertFalse(target.is_upload_done(id))
+        self.assertTrue(target.uploads[id] is target.claim_next_entry())
 
     def test_cancel_upload(self):
         target = py_lightweight_uploader.LightweightUploader()
         id = target.enqueue_upload('fake_filename', 'http://fake_uploadurl/')
         target.cancel_upload(id)
-        self.assertEquals(0, len(target.upload_queue))
+        self.assertEquals(0, len(target.uploads))
+        self.assertTrue(target.is_upload_done(id))
+        self.assertEquals(None, target.claim_next_entry())
 
     def test_additional_data_etc(self):
         target = py_lightweight_uploader.LightweightUploader()
@@ -304,7 +1216,7 @@ class TestLightweightUploader(PatchedTestCase):
                                    on_complete=mock_on_complete,
                                    content='fake content'
                                 )
-        f = target.upload_queue[0].file
+        f = target.uploads[id].file
         self.assertEquals(
             ParseResult(scheme='http', netloc='fake_uploadurl.com', path='/fake_path/', params='', query='a=b&c=d&e=f', fragment='fake_fragment'),
             f.destination_url)
@@ -313,6 +1225,441 @@ class TestLightweightUploader(PatchedTestCase):
         self.assertEquals(mock_on_complete, f.on_complete)
         self.assertEquals('fake content', f.content)
 
+    def test_claim_next_entry_skips_entries_in_progress(self):
+        target = py_lightweight_uploader.LightweightUploader(worker_count=2)
+        first_id = target.enqueue_upload('fake_filename_1', 'http://fake_uploadurl/')
+        second_id = target.enqueue_upload('fake_filename_2', 'http://fake_uploadurl/')
+        self.assertEquals(first_id, target.claim_next_entry().id)
+        self.assertEquals(second_id, target.claim_next_entry().id)
+        self.assertEquals(None, target.claim_next_entry())
+
+    def test_cancel_upload_in_progress(self):
+        target = py_lightweight_uploader.LightweightUploader()
+        id = target.enqueue_upload('fake_filename', 'http://fake_uploadurl/')
+        entry = target.claim_next_entry()
+        target.cancel_upload(id)
+        self.assertTrue(entry.cancelled)
+        self.assertEquals(0, len(target.uploads))
+
+    def test_submit_upload_resolves_to_final_response(self):
+        target = py_lightweight_uploader.LightweightUploader()
+        mock_on_complete = Mock()
+        mock_callback = Mock()
+        future = target.submit_upload('fake_filename', 'http://fake_uploadurl/', on_complete=mock_on_complete)
+        future.add_done_callback(mock_callback)
+        self.assertEquals(future.id, target.claim_next_entry().id)
+        self.assertFalse(future.done())
+        self.assertRaises(py_lightweight_uploader.UploadTimeoutError, future.result, 0)
+
+        fake_response = Mock(spec=HTTPResponse)
+        target.uploads[future.id].file.on_complete(response=fake_response)
+        mock_on_complete.assert_called_once_with(response=fake_response)
+        mock_callback.assert_called_once_with(future)
+        self.assertTrue(fake_response is future.result(0))
+
+    def test_cancel_submitted_upload(self):
+        target = py_lightweight_uploader.LightweightUploader()
+        future = target.submit_upload('fake_filename', 'http://fake_uploadurl/')
+        target.cancel_upload(future.id)
+        self.assertTrue(future.cancelled())
+        self.assertRaises(py_lightweight_uploader.UploadCancelledError, future.result, 0)
+
+    def test_wait_all_wakes_when_queue_drains(self):
+        target = py_lightweight_uploader.LightweightUploader(worker_count=2)
+        target.start()
+        go = Event()
+        self.mock_file.file_name = 'fake_filename'
+        self.mock_file.destination_url = py_lightweight_uploader.urlparse('http://fake_uploadurl/')
+        self.mock_file.post_next_chunk.side_effect = lambda: go.wait(5) and 0
+        target.enqueue_file(self.mock_file)
+        id = target.enqueue_file(self.mock_file)
+
+        self.assertFalse(target.wait_all(timeout=0.05))
+        self.assertFalse(target.join_upload(id, timeout=0.05))
+        go.set()
+        self.assertTrue(target.join_upload(id, timeout=5))
+        self.assertTrue(target.wait_all(timeout=5))
+        self.assertEquals(0, len(target.uploads))
+
+    def test_failed_upload_does_not_stop_the_others(self):
+        target = py_lightweight_uploader.LightweightUploader()
+        failing_file = Mock(spec=py_lightweight_uploader.UploadableFile)
+        failing_file.bytes_posted = 0
+        failing_file.retry_at = 0
+        failing_file.file_name = 'fake_failing_filename'
+        failing_file.destination_url = py_lightweight_uploader.urlparse('http://fake_uploadurl/')
+        failing_file.post_next_chunk.return_value = -1
+        self.mock_file.file_name = 'fake_filename'
+        self.mock_file.destination_url = py_lightweight_uploader.urlparse('http://fake_uploadurl/')
+        self.mock_file.post_next_chunk.return_value = 0
+        failing_id = target.enqueue_file(failing_file)
+        id = target.enqueue_file(self.mock_file)
+        target.start()
+        self.assertTrue(target.wait_all(timeout=5))
+        self.assertTrue(target.is_alive())
+        self.assertTrue(target.is_upload_done(failing_id))
+        self.assertEquals(1, self.mock_file.post_next_chunk.call_count)
+
+    def test_upload_already_gone_does_not_stop_the_worker(self):
+        target = py_lightweight_uploader.LightweightUploader()
+        vanishing_file = Mock(spec=py_lightweight_uploader.UploadableFile)
+        vanishing_file.bytes_posted = 0
+        vanishing_file.retry_at = 0
+        vanishing_file.file_name = 'fake_vanishing_filename'
+        vanishing_file.destination_url = py_lightweight_uploader.urlparse('http://fake_uploadurl/')
+        vanishing_file.post_next_chunk.side_effect = lambda: target.uploads.pop(vanishing_id) and 0
+        self.mock_file.file_name = 'fake_filename'
+        self.mock_file.destination_url = py_lightweight_uploader.urlparse('http://fake_uploadurl/')
+        self.mock_file.post_next_chunk.return_value = 0
+        vanishing_id = target.enqueue_file(vanishing_file)
+        target.enqueue_file(self.mock_file)
+        target.start()
+        self.assertTrue(target.wait_all(timeout=5))
+        self.assertTrue(target.is_alive())
+        self.assertEquals(1, self.mock_file.post_next_chunk.call_count)
+
+    def test_backing_off_upload_lets_others_go_first(self):
+        target = py_lightweight_uploader.LightweightUploader()
+        self.mock_file.retry_at = time() + 60
+        self.mock_file.post_next_chunk.return_value = 100
+        self.mock_file.file_name = 'fake_filename'
+        self.mock_file.destination_url = py_lightweight_uploader.urlparse('http://fake_uploadurl/')
+        second_file = Mock(spec=py_lightweight_uploader.UploadableFile)
+        second_file.bytes_posted = 0
+        second_file.retry_at = 0
+        second_file.file_name = 'fake_filename_2'
+        second_file.destination_url = self.mock_file.destination_url
+        second_file.post_next_chunk.return_value = 0
+        id = target.enqueue_file(self.mock_file)
+        second_id = target.enqueue_file(second_file)
+        target.start()
+        self.assertTrue(target.join_upload(second_id, timeout=5))
+        self.assertEquals(1, len(target.delayed))
+        self.assertEquals(1, self.mock_file.post_next_chunk.call_count)
+        target.cancel_upload(id)
+        self.assertEquals([], target.delayed)
+
+    def test_wait_all_when_not_running(self):
+        target = py_lightweight_uploader.LightweightUploader()
+        target.enqueue_upload('fake_filename', 'http://fake_uploadurl/')
+        self.assertTrue(target.wait_all(timeout=0))
+
+    def test_cancel_keeps_fifo_order_of_the_rest(self):
+        target = py_lightweight_uploader.LightweightUploader()
+        ids = [target.enqueue_upload('fake_filename_%d' % i, 'http://fake_uploadurl/') for i in range(4)]
+        target.cancel_upload(ids[1])
+        self.assertEquals([ids[0], ids[2], ids[3]], [target.claim_next_entry().id for i in range(3)])
+        self.assertEquals(None, target.claim_next_entry())
+
+    def test_journal_replay_resumes_upload(self):
+        journal = py_lightweight_uploader.UploadJournal(':memory:')
+        target = py_lightweight_uploader.LightweightUploader(journal=journal)
+        id = target.enqueue_upload('fake_filename', 'http://fake_uploadurl/path', additional_data={'a': 'b'},
+                                   destination_filename='fake_destination_filename')
+        f = target.uploads[id].file
+        f.received_ranges = [(0, 99), (200, 299)]
+        journal.update(id, f)
+        target.enqueue_upload('fake_filename_2', 'http://fake_uploadurl/', content='not journaled')
+
+        restarted = py_lightweight_uploader.LightweightUploader(journal=journal)
+        self.assertEquals([id], restarted.replay_journal())
+        resumed = restarted.uploads[id].file
+        self.assertEquals('fake_filename', resumed.file_name)
+        self.assertEquals('/path?a=b', resumed.uri)
+        self.assertEquals('fake_destination_filename', resumed.destination_filename)
+        self.assertEquals(f.session_id, resumed.session_id)
+        self.assertEquals([(0, 99), (200, 299)], resumed.received_ranges)
+        self.assertEquals(100, resumed.next_byte_to_upload)
+
+        restarted.cancel_upload(id)
+        self.assertEquals([], list(journal.entries()))
+
+    def test_start_replays_only_what_is_not_queued(self):
+        journal = py_lightweight_uploader.UploadJournal(':memory:')
+        id = py_lightweight_uploader.LightweightUploader(journal=journal).enqueue_upload(
+            'fake_filename', 'http://fake_uploadurl/')
+        target = py_lightweight_uploader.LightweightUploader(journal=journal)
+        queued_id = target.enqueue_upload('fake_filename_2', 'http://fake_uploadurl/')     # journaled too
+        target.set_enabled(False)
+        target.start()
+        self.assertEquals(set([id, queued_id]), set(target.uploads))
+        self.assertEquals(2, len(target.upload_queue))
+        self.assertEquals([], target.replay_journal())
+        self.assertRaises(ValueError, target.enqueue_file,
+                          py_lightweight_uploader.UploadableFile('fake_filename', 'http://fake_uploadurl/'), id=id)
+        self.assertEquals(2, len(target.upload_queue))
+
+    def test_higher_priority_goes_first(self):
+        target = py_lightweight_uploader.LightweightUploader()
+        low_id = target.enqueue_upload('fake_filename_1', 'http://fake_uploadurl/')
+        high_id = target.enqueue_upload('fake_filename_2', 'http://fake_uploadurl/', priority=5)
+        self.assertEquals(high_id, target.claim_next_entry().id)
+        self.assertEquals(low_id, target.claim_next_entry().id)
+
+    def test_uploads_take_turns_by_bytes_sent(self):
+        queue = py_lightweight_uploader.FairShareQueue()
+        big = py_lightweight_uploader.UploadQueueEntry('big', None, tenant='a')
+        queue.add(big)
+        self.assertTrue(big is queue.pop())
+        queue.charge(big, 1000)
+        queue.push(big)
+        small = py_lightweight_uploader.UploadQueueEntry('small', None, tenant='a')
+        queue.add(small)        # arrives after big has had a chunk, goes ahead of its next one
+        self.assertTrue(small is queue.pop())
+        self.assertTrue(big is queue.pop())
+
+    def test_tenants_get_equal_shares(self):
+        queue = py_lightweight_uploader.FairShareQueue()
+        busy = [py_lightweight_uploader.UploadQueueEntry(i, None, tenant='busy') for i in range(3)]
+        quiet = py_lightweight_uploader.UploadQueueEntry('quiet', None, tenant='quiet')
+        for entry in busy + [quiet]:
+            queue.add(entry)
+        sent = {'busy': 0, 'quiet': 0}
+        for i in range(40):
+            entry = queue.pop()
+            sent[entry.tenant] += 100
+            queue.charge(entry, 100)
+            queue.push(entry)
+        self.assertTrue(abs(sent['busy'] - sent['quiet']) <= 300, sent)
+
+    def test_set_rate_limit(self):
+        target = py_lightweight_uploader.LightweightUploader()
+        id = target.enqueue_upload('fake_filename', 'http://fake_uploadurl:8080/')
+        f = target.uploads[id].file
+        self.assertEquals([target.rate_limit, target.host_rate_limits['fake_uploadurl:8080']], f.throttles)
+
+        target.set_rate_limit(1000)
+        target.set_rate_limit(2000, host='fake_uploadurl:8080')
+        target.set_rate_limit(3000, upload_id=id)
+        target.set_rate_limit(4000, upload_id=id)
+        self.assertEquals(1000, target.rate_limit.rate)
+        self.assertEquals(2000, target.host_rate_limits['fake_uploadurl:8080'].rate)
+        self.assertEquals(3, len(f.throttles))
+        self.assertEquals(4000, f.rate_limit.rate)
+
+    def test_set_enabled_pauses_everything(self):
+        mock_pool = Mock(spec=py_lightweight_uploader.ConnectionPool)
+        target = py_lightweight_uploader.LightweightUploader(connection_pool=mock_pool)
+        id = target.enqueue_upload('fake_filename', 'http://fake_uploadurl/')
+        target.setEnabled(False)
+        mock_pool.close_idle.assert_called_once_with()
+        self.assertEquals(None, target.claim_next_entry())
+        target.set_enabled(True)
+        self.assertEquals(id, target.claim_next_entry().id)
+
+    def test_pause_and_resume_upload(self):
+        target = py_lightweight_uploader.LightweightUploader()
+        paused_id = target.enqueue_upload('fake_filename_1', 'http://fake_uploadurl/')
+        id = target.enqueue_upload('fake_filename_2', 'http://fake_uploadurl/')
+        target.pause_upload(paused_id)
+        self.assertEquals(id, target.claim_next_entry().id)
+        self.assertEquals(None, target.claim_next_entry())
+        self.assertEquals([paused_id], target.paused.keys())
+        self.assertFalse(target.is_upload_done(paused_id))
+
+        target.resume_upload(paused_id)
+        self.assertEquals({}, target.paused)
+        self.assertEquals(paused_id, target.claim_next_entry().id)
+
+    def test_pause_upload_in_flight(self):
+        target = py_lightweight_uploader.LightweightUploader()
+        in_flight = Event()
+        go = Event()
+        def post_next_chunk():
+            in_flight.set()
+            go.wait(5)
+            return 100
+        self.mock_file.file_name = 'fake_filename'
+        self.mock_file.destination_url = py_lightweight_uploader.urlparse('http://fake_uploadurl/')
+        self.mock_file.post_next_chunk.side_effect = post_next_chunk
+        id = target.enqueue_file(self.mock_file)
+        target.start()
+        self.assertTrue(in_flight.wait(5))
+        target.pause_upload(id)
+        go.set()
+        deadline = time() + 5
+        while id not in target.paused and time() < deadline:
+            sleep(0.01)
+        self.assertTrue(id in target.paused)
+        self.assertEquals(1, self.mock_file.post_next_chunk.call_count)
+        target.cancel_upload(id)
+
+    def test_snapshot_and_prometheus_text(self):
+        target = py_lightweight_uploader.LightweightUploader()
+        id = target.enqueue_upload('fake_filename', 'http://fake_uploadurl/', content='fake content')
+        target.pause_upload(id)
+        target.enqueue_upload('fake_filename_2', 'http://fake_uploadurl/')
+        target.claim_next_entry()
+        target.metrics.chunk_sent(5, 0.02)
+        target.metrics.upload_finished(False)
+
+        snapshot = target.snapshot()
+        self.assertEquals(1, snapshot['uploads_paused'])
+        self.assertEquals(0, snapshot['uploads_queued'])
+        self.assertEquals(1, snapshot['uploads_in_progress'])
+        self.assertEquals((0, 12), snapshot['uploads'][id])
+        self.assertTrue(snapshot['lock_acquisitions'] > 0)
+
+        text = target.prometheus_text().splitlines()
+        self.assertTrue('lightweight_uploader_bytes_sent_total 5' in text)
+        self.assertTrue('lightweight_uploader_uploads_finished_total{outcome="failed"} 1' in text)
+        self.assertTrue('lightweight_uploader_request_seconds_bucket{le="0.025"} 1' in text)
+        self.assertTrue('lightweight_uploader_request_seconds_bucket{le="+Inf"} 1' in text)
+        self.assertTrue('lightweight_uploader_uploads{state="paused"} 1' in text)
+        self.assertTrue('lightweight_uploader_upload_bytes_total{upload_id="%s"} 12' % id in text)
+
+    def test_duplicate_upload_is_coalesced_then_cached(self):
+        target = py_lightweight_uploader.LightweightUploader(cache=py_lightweight_uploader.UploadCache())
+        go = Event()
+        fake_response = Mock(spec=HTTPResponse)
+        fake_response.status = 200
+        first_on_complete = Mock()
+        duplicate_on_complete = Mock()
+        cached_on_complete = Mock()
+        id = target.enqueue_upload('fake_filename', 'http://fake_uploadurl/', content='fake content',
+                                   on_complete=first_on_complete)
+        def post_next_chunk(f):
+            go.wait(5)
+            f.response = fake_response
+            f.on_complete(response=fake_response)
+            return 0
+        self.assertEquals(id, target.enqueue_upload('fake_filename', 'http://fake_uploadurl/', content='fake content',
+                                                    on_complete=duplicate_on_complete))
+        other_id = target.enqueue_upload('fake_filename', 'http://fake_uploadurl/other', content='fake content')
+        self.assertNotEqual(id, other_id)
+        self.assertEquals(2, len(target.uploads))
+        target.cancel_upload(other_id)
+
+        with patch.object(py_lightweight_uploader.UploadableFile, 'post_next_chunk',
+                          autospec=True, side_effect=post_next_chunk):
+            target.start()
+            go.set()
+            self.assertTrue(target.join_upload(id, timeout=5))
+        first_on_complete.assert_called_once_with(response=fake_response)
+        duplicate_on_complete.assert_called_once_with(response=fake_response)
+
+        cached_id = target.enqueue_upload('fake_filename', 'http://fake_uploadurl/', content='fake content',
+                                          on_complete=cached_on_complete)
+        self.assertTrue(target.is_upload_done(cached_id))
+        cached_on_complete.assert_called_once_with(response=fake_response)
+
+    def test_duplicate_on_complete_raising_does_not_stop_the_uploader(self):
+        target = py_lightweight_uploader.LightweightUploader(cache=py_lightweight_uploader.UploadCache())
+        fake_response = Mock(spec=HTTPResponse)
+        fake_response.status = 200
+        raising_on_complete = Mock(side_effect=ValueError('fake callback bug'))
+        later_on_complete = Mock()
+        id = target.enqueue_upload('fake_filename', 'http://fake_uploadurl/', content='fake content')
+        target.enqueue_upload('fake_filename', 'http://fake_uploadurl/', content='fake content',
+                              on_complete=raising_on_complete)
+        duplicate = target.submit_upload('fake_filename', 'http://fake_uploadurl/', content='fake content')
+        later_id = target.enqueue_upload('fake_filename_2', 'http://fake_uploadurl/', content='other content',
+                                         on_complete=later_on_complete)
+        def post_next_chunk(f):
+            f.response = fake_response
+            if f.on_complete:
+                f.on_complete(response=fake_response)
+            return 0
+        with patch.object(py_lightweight_uploader.UploadableFile, 'post_next_chunk',
+                          autospec=True, side_effect=post_next_chunk):
+            target.start()
+            self.assertTrue(target.join_upload(later_id, timeout=5))
+        self.assertTrue(target.is_alive())
+        raising_on_complete.assert_called_once_with(response=fake_response)
+        self.assertEquals(fake_response, duplicate.result(timeout=5))
+        later_on_complete.assert_called_once_with(response=fake_response)
+        self.assertEquals(1, self.mock_warning.call_count)
+
+    def test_duplicates_to_a_destination_group_are_coalesced(self):
+        target = py_lightweight_uploader.LightweightUploader(cache=py_lightweight_uploader.UploadCache())
+        group = py_lightweight_uploader.DestinationGroup(['http://host_a/upload', 'http://host_b/upload'])
+        id = target.enqueue_upload('fake_filename', group, content='x' * 100, additional_data={'a': 'b'})
+        self.assertEquals(id, target.enqueue_upload('fake_filename', group, content='x' * 100,
+                                                    additional_data={'a': 'b'}))
+        other_id = target.enqueue_upload('fake_filename', group, content='x' * 100, additional_data={'a': 'c'})
+        self.assertNotEqual(id, other_id)
+        self.assertEquals([100, 100], group.outstanding)
+        target.cancel_upload(id)                    # its duplicate is queued in its place
+        self.assertEquals([100, 100], group.outstanding)
+        for id in list(target.uploads):
+            target.cancel_upload(id)
+        self.assertEquals([0, 0], group.outstanding)
+        self.assertEquals({}, group.assigned)
+
+    def test_cancel_queues_duplicates_again(self):
+        target = py_lightweight_uploader.LightweightUploader(cache=py_lightweight_uploader.UploadCache())
+        fake_response = Mock(spec=HTTPResponse)
+        fake_response.status = 200
+        future = target.submit_upload('fake_filename', 'http://fake_uploadurl/', content='fake content')
+        duplicate = target.submit_upload('fake_filename', 'http://fake_uploadurl/', content='fake content')
+        duplicate_on_complete = Mock()
+        id = target.enqueue_upload('fake_filename', 'http://fake_uploadurl/', content='fake content',
+                                   on_complete=duplicate_on_complete)
+        self.assertEquals(future.id, duplicate.id)
+        self.assertEquals(future.id, id)
+        target.cancel_upload(future.id)
+        self.assertTrue(future.cancelled())
+        self.assertFalse(duplicate.cancelled())
+        self.assertNotEqual(future.id, duplicate.id)
+        self.assertEquals([duplicate.id], list(target.uploads))
+        self.assertEquals(duplicate.id, target.cache.in_flight.values()[0][0])
+
+        def post_next_chunk(f):
+            f.response = fake_response
+            f.call_on_complete()
+            return 0
+        with patch.object(py_lightweight_uploader.UploadableFile, 'post_next_chunk',
+                          autospec=True, side_effect=post_next_chunk):
+            target.start()
+            self.assertEquals(fake_response, duplicate.result(timeout=5))
+            self.assertTrue(target.wait_all(timeout=5))
+        duplicate_on_complete.assert_called_once_with(response=fake_response)
+
+    def test_enqueue_many_takes_lock_once_per_batch(self):
+        journal = py_lightweight_uploader.UploadJournal(':memory:')
+        target = py_lightweight_uploader.LightweightUploader(journal=journal)
+        ids = target.enqueue_many(['fake_filename_%d' % i for i in range(5)], 'http://fake_uploadurl/path',
+                                  additional_data={'a': 'b'}, batch_size=2, priority=3)
+        self.assertEquals(5, len(ids))
+        self.assertEquals(3, target.metrics.lock_acquisitions)
+        self.assertEquals(5, len(list(journal.entries())))
+        files = [target.uploads[id].file for id in ids]
+        self.assertTrue(files[0].destination_url is files[4].destination_url)
+        self.assertEquals('/path?a=b', files[4].uri)
+        self.assertEquals(ids, [target.claim_next_entry().id for id in ids])
+
+    def test_enqueue_directory_is_lazy(self):
+        path = mkdtemp()
+        try:
+            for file_name in ('a.json', 'b.json', 'c.txt'):
+                open(join(path, file_name), 'w').close()
+            target = py_lightweight_uploader.LightweightUploader()
+            self.assertEquals(None, target.enqueue_directory(path, 'http://fake_uploadurl/', '*.json', batch_size=1))
+            self.assertEquals(0, len(target.uploads))
+            target.refill()
+            self.assertEquals(1, len(target.uploads))
+            target.refill()
+            target.refill()
+            self.assertEquals([], target.sources)
+            self.assertEquals([join(path, 'a.json'), join(path, 'b.json')],
+                              sorted(entry.file.file_name for entry in target.uploads.values()))
+        finally:
+            rmtree(path)
+
+    def test_uploads_to_one_place_share_their_parsed_url(self):
+        target = py_lightweight_uploader.LightweightUploader()
+        ids = [target.enqueue_upload('fake_filename_%d' % i, 'http://fake_uploadurl/', additional_data={'a': 'b'})
+               for i in range(2)]
+        other_id = target.enqueue_upload('fake_filename', 'http://fake_uploadurl/', additional_data={'a': 'c'})
+        urls = [target.uploads[id].file.destination_url for id in ids + [other_id]]
+        self.assertTrue(urls[0] is urls[1])
+        self.assertEquals('a=c', urls[2].query)
+        future = target.submit_upload('fake_filename', 'http://fake_uploadurl/', additional_data=[('a', 'b')])
+        self.assertEquals('a=b', target.uploads[future.id].file.destination_url.query)
+
+    def test_worker_count_must_be_positive(self):
+        self.assertRaises(ValueError, py_lightweight_uploader.LightweightUploader, worker_count=0)
+
 #    @patch.object(py_lightweight_uploader.UploadableFile, 'post_next_chunk')
 #    def test_run_partial_upload(self, mock_post_next_chunk):
 #        mock_post_next_chunk.return_value = 1
@@ -342,3 +1689,122 @@ class TestLightweightUploader(PatchedTestCase):
 #
 #        self.assertEquals(0, len(target.upload_queue))
 
+
+class TestAgainstResumableUploadServer(unittest2.TestCase):
+
+    def setUp(self):
+        self.server = bench_py_lightweight_uploader.ResumableUploadServer(out_of_order=0.5, seed=1).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_uploads_complete_despite_out_of_order_acknowledgements(self):
+        elapsed, total_bytes, latencies, failed = bench_py_lightweight_uploader.run_benchmark(
+            self.server.url, [5000, 3000, 10], chunk_size=1023, worker_count=2, parallel_chunks=2)
+        self.assertEquals(0, failed)
+        self.assertEquals(3, len(latencies))
+        self.assertEquals(3, self.server.completed)
+
+    def test_enqueue_directory(self):
+        path = mkdtemp()
+        try:
+            for i in range(7):
+                with open(join(path, 'receipt_%d.json' % i), 'w') as f:
+                    f.write('{"receipt": %d}' % i * 100)
+            target = py_lightweight_uploader.LightweightUploader(worker_count=2)
+            target.start()
+            target.enqueue_directory(path, self.server.url, '*.json', batch_size=3, chunk_size=1000)
+            self.assertTrue(target.wait_all(timeout=10))
+            self.assertEquals(7, self.server.completed)
+            self.assertEquals(7, target.metrics.uploads_completed)
+        finally:
+            rmtree(path)
+
+    def test_destination_group_fails_over_from_a_dead_host(self):
+        dead = socket.socket()
+        dead.bind(('127.0.0.1', 0))
+        dead_url = 'http://%s:%d/upload' % dead.getsockname()
+        dead.close()                        # nothing listens there now
+        group = py_lightweight_uploader.DestinationGroup([dead_url, self.server.url], max_failures=1)
+        target = py_lightweight_uploader.LightweightUploader(
+            worker_count=2, retry_policy=py_lightweight_uploader.RetryPolicy(max_retries=3, base_delay=0.01))
+        target.start()
+        with patch('py_lightweight_uploader.warning'):
+            futures = [target.submit_upload('receipt_%d.json' % i, group, content='x' * 3000, chunk_size=1000)
+                       for i in range(6)]
+            self.assertTrue(target.wait_all(timeout=10))
+        self.assertEquals([200] * 6, [future.result().status for future in futures])
+        self.assertEquals(6, self.server.completed)
+        self.assertTrue(group.is_down(0))
+        self.assertEquals([0, 0], group.outstanding)
+
+    def test_permanent_redirect_is_only_followed_once(self):
+        target = py_lightweight_uploader.LightweightUploader()
+        target.start()
+        with patch('py_lightweight_uploader.info'):
+            first = target.submit_upload('receipt_0.json', self.server.moved_url, content='x' * 3000, chunk_size=1000)
+            self.assertEquals(200, first.result(timeout=10).status)
+            futures = [target.submit_upload('receipt_%d.json' % i, self.server.moved_url, content='x' * 3000,
+                                            chunk_size=1000) for i in range(1, 4)]
+            self.assertTrue(target.wait_all(timeout=10))
+        self.assertEquals([200] * 3, [future.result().status for future in futures])
+        self.assertEquals(4, self.server.completed)
+        self.assertEquals(1, self.server.redirected)
+
+    def test_on_complete_raising_does_not_fail_the_upload(self):
+        target = py_lightweight_uploader.LightweightUploader(cache=py_lightweight_uploader.UploadCache())
+        target.start()
+        with patch('py_lightweight_uploader.warning') as mock_warning:
+            future = target.submit_upload('receipt.json', self.server.url, content='x' * 3000, chunk_size=1000,
+                                          on_complete=Mock(side_effect=ValueError('fake callback bug')))
+            self.assertEquals(200, future.result(timeout=10).status)
+            self.assertTrue(target.wait_all(timeout=10))
+        self.assertEquals(1, mock_warning.call_count)
+        self.assertEquals(1, self.server.completed)
+        self.assertEquals((1, 0), (target.metrics.uploads_completed, target.metrics.uploads_failed))
+        self.assertEquals(1, len(target.cache.completed))
+
+    def test_compressed_uploads_stay_within_max_open_files(self):
+        target = py_lightweight_uploader.LightweightUploader(worker_count=4, max_open_files=2)
+        most_open = []
+        open_handle = target.file_handles.open
+
+        def counting_open(file, opener=None):
+            handle = open_handle(file, opener)
+            most_open.append(len(target.file_handles))
+            return handle
+        target.file_handles.open = counting_open
+        target.start()
+        for i in range(12):
+            target.submit_upload('receipt_%d.json' % i, self.server.url, content=''.join(
+                '{"receipt": %d, "line": %d}\n' % (i, line) for line in range(500)),
+                chunk_size=500, compression=py_lightweight_uploader.GzipCodec())
+        self.assertTrue(target.wait_all(timeout=10))
+        self.assertEquals(12, self.server.completed)
+        self.assertEquals(2, max(most_open))
+        self.assertEquals(0, len(target.file_handles))
+
+    def test_parallel_and_single_chunk_uploads_share_small_budgets(self):
+        path = mkdtemp()
+        try:
+            target = py_lightweight_uploader.LightweightUploader(
+                worker_count=4, max_open_files=2,
+                connection_pool=py_lightweight_uploader.ConnectionPool(max_per_host=2))
+            open_handle = target.file_handles.open
+
+            def slow_open(file, opener=None):
+                handle = open_handle(file, opener)
+                sleep(0.01)                 # long enough for the others to take what is left
+                return handle
+            target.file_handles.open = slow_open
+            target.start()
+            for i in range(16):
+                file_name = join(path, 'receipt_%d.json' % i)
+                with open(file_name, 'w') as f:
+                    f.write('{"receipt": %d}\n' % i * 500)
+                target.submit_upload(file_name, self.server.url, chunk_size=1000, parallel_chunks=1 + i % 2)
+            self.assertTrue(target.wait_all(timeout=10))
+            self.assertEquals(16, self.server.completed)
+        finally:
+            rmtree(path)